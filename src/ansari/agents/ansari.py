@@ -8,11 +8,11 @@
 
 import copy
 import json
+import logging
+import random
 import time
 import traceback
 
-import litellm
-
 from ansari.ansari_db import MessageLogger
 from ansari.ansari_logger import get_logger
 from ansari.config import Settings
@@ -25,6 +25,40 @@ from ansari.util.prompt_mgr import PromptMgr
 # previous logger name: __name__ + ".Ansari"
 logger = get_logger(__name__)
 
+# Backoff between retries of a failed completion or API call (used by AnsariClaude too): exponential with jitter,
+# starting around RETRY_INITIAL_WAIT seconds and capped at RETRY_MAX_WAIT, so retries from concurrent requests don't
+# all wake up at once. A Retry-After header sent with a rate limit error takes precedence (up to RETRY_MAX_RETRY_AFTER
+# seconds).
+RETRY_INITIAL_WAIT = 0.5
+RETRY_MAX_WAIT = 8.0
+RETRY_MAX_RETRY_AFTER = 60.0
+
+
+def _retry_delay(failures: int, exception: Exception | None = None) -> float:
+    """Seconds to wait before retrying after `failures` consecutive failed attempts, the last one raising `exception`."""
+    response = getattr(exception, "response", None)
+    headers = getattr(response, "headers", None)
+    retry_after = headers.get("retry-after") if headers is not None else None
+    if retry_after:
+        try:
+            return min(max(float(retry_after), 0.0), RETRY_MAX_RETRY_AFTER)
+        except ValueError:
+            pass  # An HTTP date rather than seconds; fall back to our own backoff
+    return min(RETRY_MAX_WAIT, RETRY_INITIAL_WAIT * 2 ** (failures - 1)) + random.uniform(0, RETRY_INITIAL_WAIT)
+
+
+def _is_retryable_completion_error(exception: Exception) -> bool:
+    """Whether a failed completion is worth retrying: connection problems, timeouts, rate limits and server errors.
+
+    Other errors (a bad request, or a bug on our side) fail the same way on every attempt, so they are raised at once.
+    """
+    import litellm
+
+    if isinstance(exception, litellm.APIConnectionError):  # Includes litellm.Timeout
+        return True
+    status_code = getattr(exception, "status_code", None)
+    return isinstance(status_code, int) and (status_code == 429 or status_code >= 500)
+
 
 class Ansari:
     def __init__(self, settings: Settings, message_logger: MessageLogger = None, json_format=False):
@@ -112,6 +146,9 @@ class Ansari:
                 yield m
 
     def get_completion(self, **kwargs):
+        # litellm takes seconds to import and AnsariClaude (a subclass) never calls it, so import it on first use
+        import litellm
+
         return litellm.completion(**kwargs)
 
     def process_message_history(self, use_tool=True):
@@ -129,26 +166,29 @@ class Ansari:
         failures = 0
         response = None
 
+        params = {
+            **common_params,
+            **({"tools": self.tools, "tool_choice": "auto"} if use_tool else {}),
+            **({"response_format": {"type": "json_object"}} if self.json_format else {}),
+        }
         while not response:
             try:
-                params = {
-                    **common_params,
-                    **({"tools": self.tools, "tool_choice": "auto"} if use_tool else {}),
-                    **({"response_format": {"type": "json_object"}} if self.json_format else {}),
-                }
                 response = self.get_completion(**params)
 
             except Exception as e:
                 failures += 1
                 logger.warning(
-                    f"Exception occurred in process_message_history function: \n{e}\n",
+                    f"{type(e).__name__} occurred in process_message_history function: \n{e}\n",
                 )
                 logger.warning(traceback.format_exc())
-                logger.warning("Retrying in 5 seconds...")
-                time.sleep(5)
+                if not _is_retryable_completion_error(e):
+                    raise
                 if failures >= self.settings.MAX_FAILURES:
                     logger.error("Too many failures, aborting")
-                    raise Exception("Too many failures") from e
+                    raise
+                delay = _retry_delay(failures, e)
+                logger.warning(f"Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
 
         words = ""
         tool_calls = []
@@ -236,26 +276,29 @@ class Ansari:
         failures = 0
         response = None
 
+        params = {
+            **common_params,
+            **({"tools": self.tools, "tool_choice": "auto"} if use_tool else {}),
+            **({"response_format": {"type": "json_object"}} if self.json_format else {}),
+        }
         while not response:
             try:
-                params = {
-                    **common_params,
-                    **({"tools": self.tools, "tool_choice": "auto"} if use_tool else {}),
-                    **({"response_format": {"type": "json_object"}} if self.json_format else {}),
-                }
                 response = self.get_completion(**params)
 
             except Exception as e:
                 failures += 1
                 logger.warning(
-                    f"Exception occurred in process_one_round function: \n{e}\n",
+                    f"{type(e).__name__} occurred in process_one_round function: \n{e}\n",
                 )
                 logger.warning(traceback.format_exc())
-                logger.warning("Retrying in 5 seconds...")
-                time.sleep(5)
+                if not _is_retryable_completion_error(e):
+                    raise
                 if failures >= self.settings.MAX_FAILURES:
                     logger.error("Too many failures, aborting")
-                    raise Exception("Too many failures") from e
+                    raise
+                delay = _retry_delay(failures, e)
+                logger.warning(f"Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
 
         words = ""
         tool_calls = []
@@ -334,23 +377,23 @@ class Ansari:
         tool_args: str,
         tool_id: str,
     ):
-        if tool_name not in self.tool_name_to_instance.keys():
+        tool_instance = self.tool_name_to_instance.get(tool_name)
+        if tool_instance is None:
             logger.warning(f"Unknown tool name: {tool_name}")
             return
         try:
-            logger.debug(f"Tool args: {tool_args}")
+            logger.debug("Tool args: %s", tool_args)
             args_dict = json.loads(tool_args)
-            logger.debug(f"Parsed tool args: {args_dict}")
+            logger.debug("Parsed tool args: %s", args_dict)
             query: str = args_dict["query"]
             logger.debug(f"Extracted query: {query}")
         except json.JSONDecodeError:
             logger.error(f"JSON decode error for tool args: {tool_args}")
-            raise json.JSONDecodeError
+            raise
         except KeyError as e:
             logger.error(f"Missing key in tool args: {e} - Tool args: {tool_args}")
             query = ""
 
-        tool_instance = self.tool_name_to_instance[tool_name]
         logger.debug(f"Running {tool_name} with query: {query}")
         try:
             # Get raw results directly using run() instead of run_as_list()
@@ -360,7 +403,7 @@ class Ansari:
             # Format the results as a list of strings
             results = tool_instance.format_as_list(raw_results)
             logger.debug(f"Formatted results type: {type(results)}")
-            logger.debug(f"Results sample: {str(results)[:200] if results else 'Empty results'}")
+            logger.debug("Results sample: %.200s", results if results else "Empty results")
         except Exception as e:
             import traceback
 
@@ -435,6 +478,10 @@ class Ansari:
         Args:
             message_history (list): The message history to be truncated and logged.
         """
+        # Copying and formatting the whole history is expensive, so only do it when it will be emitted
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+
         trunc_msg_hist = copy.deepcopy(message_history)
         if (
             len(trunc_msg_hist) > 1
@@ -446,7 +493,7 @@ class Ansari:
             sys_p = trunc_msg_hist[0]["content"]
             trunc_msg_hist[0]["content"] = sys_p[:15] + "..."
 
-        logger.info(
+        logger.debug(
             f"Process attempt #{count + failures + 1} of this message history:\n"
             + "-" * 60
             + f"\n{trunc_msg_hist}\n"
@@ -1,16 +1,25 @@
 import asyncio
-import copy
 import json
+import logging
+import sys
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from itertools import islice
 from typing import Generator
 
+import anthropic
 import sentry_sdk
+from tenacity import Retrying, retry_if_exception, stop_after_attempt
 
-from ansari.agents.ansari import Ansari
+from ansari.agents.ansari import Ansari, _retry_delay
 from ansari.ansari_db import MessageLogger
 from ansari.ansari_logger import get_logger
 from ansari.config import Settings, get_settings
 from ansari.util.prompt_mgr import PromptMgr
+from ansari.util.response_cache import ResponseCache, get_response_cache
 from ansari.util.robust_translation import parse_multilingual_data, process_document_source_data
 from ansari.util.translation import translate_texts_parallel
 from ansari.util.general_helpers import get_language_from_text, trim_citation_title
@@ -18,10 +27,155 @@ from ansari.util.general_helpers import get_language_from_text, trim_citation_ti
 # Set up logging
 logger = get_logger(__name__)
 
+# Streamed text deltas are buffered until at least this many characters are pending,
+# or until this many seconds have passed since the last chunk was yielded
+STREAM_FLUSH_MIN_CHARS = 32
+STREAM_FLUSH_MAX_DELAY = 0.05
+
+# Text block that precedes the documents in a successful tool_result
+TOOL_RESULT_REFERENCES_TEXT = "Please see the references below."
+
+# Assistant reply appended when a processing round leaves the message history unchanged
+LOOP_STUCK_MESSAGE = "I got stuck in a loop. Please rephrase your question."
+
+# Offline runs through the Message Batches API poll for completion this often (seconds), for at most this many
+# rounds (a round being one batch: tool calls are run locally between rounds)
+BATCH_POLL_INTERVAL = 30
+BATCH_MAX_ROUNDS = 10
+
+# Citations list entries (which may need a translation) are rendered on this many threads per agent, in a pool
+# apart from the searches so a citation is never queued behind a slow search
+CITATION_EXECUTOR_MAX_WORKERS = 4
+
+# All agents send their requests through one HTTP connection pool, so a new conversation reuses warm
+# keep-alive connections to the API instead of paying for a fresh TCP/TLS handshake
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+def _is_retryable_api_error(exception: BaseException) -> bool:
+    """Whether a failed API call is worth retrying: connection problems, rate limits and server errors.
+
+    Other errors (bad request, authentication, ...) fail the same way on every attempt, so they are raised at once.
+    """
+    if isinstance(exception, anthropic.APIConnectionError):
+        return True
+    if isinstance(exception, anthropic.APIStatusError):
+        return exception.status_code == 429 or exception.status_code >= 500
+    return False
+
+
+def _api_retry_wait(retry_state) -> float:
+    """Tenacity wait for API retries: the same backoff (and Retry-After handling) as the base Ansari agent's."""
+    return _retry_delay(retry_state.attempt_number, retry_state.outcome.exception())
+
+
+def _get_http_client():
+    """Return the process-wide HTTP client shared by every agent's Anthropic client, creating it on first use."""
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _http_client = anthropic.DefaultHttpxClient()
+    return _http_client
+
+
+class _TextCoalescer:
+    """Buffers streamed text deltas so that tiny deltas are yielded to the caller as larger chunks.
+
+    Claude streams text in deltas of a few characters each; yielding each one separately means every
+    delta pays the generator and downstream (StreamingResponse, WhatsApp, etc.) per-chunk overhead.
+    The first delta is always released immediately so time-to-first-token is unaffected.
+    """
+
+    def __init__(self, min_chars: int = STREAM_FLUSH_MIN_CHARS, max_delay: float = STREAM_FLUSH_MAX_DELAY):
+        self.min_chars = min_chars
+        self.max_delay = max_delay
+        self._parts = []
+        self._pending_chars = 0
+        self._last_flush = 0.0
+
+    def add(self, text: str) -> str:
+        """Buffer `text` and return the coalesced chunk if it is due to be yielded, else ""."""
+        self._parts.append(text)
+        self._pending_chars += len(text)
+        if self._pending_chars >= self.min_chars or time.monotonic() - self._last_flush >= self.max_delay:
+            return self.flush()
+        return ""
+
+    def flush(self) -> str:
+        """Return everything buffered so far (possibly "") and reset the buffer."""
+        if not self._parts:
+            return ""
+        chunk = "".join(self._parts)
+        self._parts.clear()
+        self._pending_chars = 0
+        self._last_flush = time.monotonic()
+        return chunk
+
+
+@dataclass(slots=True)
+class _StreamState:
+    """Mutable state of process_one_round while it consumes one streamed response."""
+
+    text_parts: list[str] = field(default_factory=list)  # Assistant response text pieces, joined once finished
+    tool_calls: list[dict] = field(default_factory=list)  # Complete tool calls
+    response_finished: bool = False  # Set once the assistant message is added, to prevent duplicate processing
+    current_tool: dict | None = None  # Tool call whose arguments are being streamed
+    json_parts: list[str] = field(default_factory=list)  # JSON fragments of current_tool, joined at content_block_stop
+    text_buffer: _TextCoalescer = field(default_factory=_TextCoalescer)  # Coalesces small text deltas
+    chunk_count: int = 0
+    content_block_count: int = 0
+    message_delta_count: int = 0
+
 
 class AnsariClaude(Ansari):
     """Claude-based implementation of the Ansari agent."""
 
+    # Claude-format tool definitions keyed by (name, description); tool schemas are static per process,
+    # so every instance after the first reuses the already-converted dicts instead of rebuilding them
+    _claude_tool_cache: dict[tuple[str, str], dict] = {}
+
+    # Normalization watermark for process_message_history: messages before _normalized_upto have already
+    # been checked, and _normalized_last is the message that sat at the watermark when it was set
+    _normalized_upto: int = 0
+    _normalized_last: dict | None = None
+
+    # The same kind of watermark for _validate_message_history, plus the IDs it collected below the watermark:
+    # (tool_use_ids, tool_result_ids, tool_use_ids of tool_results without documents)
+    _validated_upto: int = 0
+    _validated_last: dict | None = None
+    _validated_ids: tuple[set, set, list] | None = None
+
+    # The last message object passed to message_logger, so it is never logged twice
+    _last_logged_message: dict | None = None
+
+    # (message, tool_name) pairs queued by _log_message while inside _batched_logging(), else None
+    _pending_log: list[tuple[dict, str | None]] | None = None
+    # The agent's background log writer: a single thread, so its batches are written in order, and the database
+    # round trip overlaps with the next API call instead of delaying it or other conversations' turns
+    _log_executor: ThreadPoolExecutor | None = None
+    # The last batch handed to the background log writer, waited for by _wait_for_log_writes()
+    _log_write: Future | None = None
+
+    # The agent's own pool for searches (sized by settings.TOOL_EXECUTOR_MAX_WORKERS), so a tool call can start
+    # while Claude is still streaming the rest of the turn without queueing behind other conversations' searches
+    _tool_executor: ThreadPoolExecutor | None = None
+    # Outcomes of the tool calls started during the current round, keyed by tool_use id: a Future for a running
+    # search, else the error tuple or exception from preparing the call. Reset by process_one_round.
+    _started_tool_calls: dict | None = None
+    # The agent's own pool for rendering citations (see CITATION_EXECUTOR_MAX_WORKERS)
+    _citation_executor: ThreadPoolExecutor | None = None
+    # Citations list entries being rendered in the background, keyed by citation number
+    _citation_renders: dict[int, Future] | None = None
+    # Number of citations made before the current turn. Citation numbers run on across the conversation, but
+    # self.citations only holds the current turn's citations, so it doesn't grow for the life of the agent.
+    _turn_citations_start: int = 0
+
+    # Rendered system prompts keyed by prompt file; like the tool definitions they are static per process,
+    # so the prompt file is read once rather than by every new agent
+    _system_prompt_cache: dict[str, str] = {}
+
     def __init__(self, settings: Settings, message_logger: MessageLogger = None, json_format=False, system_prompt_file=None):
         """Initialize the Claude-based Ansari agent.
 
@@ -56,9 +210,15 @@ class AnsariClaude(Ansari):
         except Exception as e:
             logger.error(f"Error logging environment info: {str(e)}")
 
-        # Initialize Claude-specific client with prompt caching support
+        # Initialize Claude-specific client with prompt caching support.
+        # The SDK's own retries are disabled because _call_claude_api already retries with backoff.
+        # The client is cheap to create; its connection pool is the shared one from _get_http_client().
         try:
-            self.client = anthropic.Anthropic(default_headers={"anthropic-beta": "prompt-caching-2024-07-31"})
+            self.client = anthropic.Anthropic(
+                default_headers={"anthropic-beta": "prompt-caching-2024-07-31"},
+                max_retries=0,
+                http_client=_get_http_client(),
+            )
             logger.debug("Successfully initialized Anthropic client with prompt caching support")
         except Exception as e:
             logger.error(f"Error initializing Anthropic client: {str(e)}")
@@ -70,9 +230,28 @@ class AnsariClaude(Ansari):
 
         # Initialize empty message history for Claude (no system message)
         self.message_history = []
+        self._tool_use_ids = set()
+        self._normalized_upto = 0
+        self._normalized_last = None
+        self._validated_upto = 0
+        self._validated_last = None
+        self._validated_ids = None
+        self._last_logged_message = None
+        self._pending_log = None
+        self._log_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ansari-log")
+        self._log_write = None
+        self._started_tool_calls = None
+        self._tool_executor = ThreadPoolExecutor(
+            max_workers=settings.TOOL_EXECUTOR_MAX_WORKERS, thread_name_prefix="ansari-tool"
+        )
 
         # Initialize citation tracking
         self.citations = []
+        self._citation_renders = {}
+        self._turn_citations_start = 0
+        self._citation_executor = ThreadPoolExecutor(
+            max_workers=CITATION_EXECUTOR_MAX_WORKERS, thread_name_prefix="ansari-citation"
+        )
 
         # Initialize tool usage tracking
         self.tool_usage_history = []
@@ -92,8 +271,6 @@ class AnsariClaude(Ansari):
         Returns:
             bool: True if the message is valid, False otherwise
         """
-        logger.debug(f"Validating message with role: {message.get('role', 'unknown')}")
-
         if not isinstance(message, dict):
             logger.warning(f"Message must be a dictionary, got {type(message)}")
             return False
@@ -108,7 +285,7 @@ class AnsariClaude(Ansari):
 
         role = message["role"]
         content = message["content"]
-        logger.debug(f"Validating {role} message with content type: {type(content)}")
+        logger.debug("Validating %s message with content type: %s", role, type(content))
 
         # Assistant messages should have list content with typed blocks
         if role == "assistant":
@@ -119,8 +296,6 @@ class AnsariClaude(Ansari):
 
             # Check if any block is missing a type
             for i, block in enumerate(content):
-                logger.debug(f"Validating assistant content block {i} of type: {type(block)}")
-
                 if not isinstance(block, dict):
                     logger.warning(f"Assistant message content block {i} must be a dict, got {type(block)}")
                     return False
@@ -129,15 +304,16 @@ class AnsariClaude(Ansari):
                     logger.warning(f"Assistant message content block {i} must have a type")
                     logger.debug(f"Invalid block without type: {block}")
                     return False
+                block_type = block["type"]
 
                 # Text blocks must have text
-                if block["type"] == "text" and "text" not in block:
+                if block_type == "text" and "text" not in block:
                     logger.warning(f"Text block {i} must have text")
                     logger.debug(f"Invalid text block: {block}")
                     return False
 
                 # Tool use blocks must have id, name, and input
-                if block["type"] == "tool_use":
+                if block_type == "tool_use":
                     if "id" not in block:
                         logger.warning(f"Tool use block {i} must have an id")
                         logger.debug(f"Invalid tool use block: {block}")
@@ -153,38 +329,47 @@ class AnsariClaude(Ansari):
 
         # User messages with tool results should have the right structure
         if role == "user" and isinstance(content, list):
-            tool_result_blocks = [b for b in content if b.get("type") == "tool_result"]
-            logger.debug(f"Found {len(tool_result_blocks)} tool result blocks in user message")
-
-            if tool_result_blocks:
-                for i, block in enumerate(tool_result_blocks):
-                    if "tool_use_id" not in block:
-                        logger.warning(f"Tool result block {i} must have a tool_use_id")
-                        logger.debug(f"Invalid tool result block: {block}")
-                        return False
-                    if "content" not in block:
-                        logger.warning(f"Tool result block {i} must have content")
-                        logger.debug(f"Invalid tool result block: {block}")
-                        return False
+            # Check the tool_result blocks as they are found, in the same pass that finds them
+            i = 0
+            for block in content:
+                if block.get("type") != "tool_result":
+                    continue
+                if "tool_use_id" not in block:
+                    logger.warning(f"Tool result block {i} must have a tool_use_id")
+                    logger.debug(f"Invalid tool result block: {block}")
+                    return False
+                if "content" not in block:
+                    logger.warning(f"Tool result block {i} must have content")
+                    logger.debug(f"Invalid tool result block: {block}")
+                    return False
+                i += 1
+            logger.debug("Found %d tool result blocks in user message", i)
 
-        logger.debug(f"Message validation successful for {role} message")
+        logger.debug("Message validation successful for %s message", role)
         return True
 
-    def _log_message(self, message):
+    def _log_message(self, message, tool_name=None, *, trusted=False):
         """Log a message using the message_logger with complete representation from message_history.
 
         This ensures that the messages logged to the database match what's in the message_history.
         The database will store this in a flattened format which will be reconstructed during retrieval.
+
+        Args:
+            message: The message to log (as stored in message_history)
+            tool_name: Optional tool name to store with the message, without copying the message to add it
+            trusted: True for messages this class has just assembled itself (assistant replies and tool results),
+                which are well-formed by construction and skip validate_message
         """
         role = message.get("role", "Unknown")
-        tool_name = message.get("tool_name")
         tool_name_log = " (tool_name=" + tool_name + ")" if tool_name else ""
         content = message.get("content")
 
         logger.debug(
-            f"_log_message called with message role: {role}{tool_name_log}, "
-            f"content type: {type(content)}, "
-            f"message_history length: {len(self.message_history)}"
+            "_log_message called with message role: %s%s, content type: %s, message_history length: %d",
+            role,
+            tool_name_log,
+            type(content),
+            len(self.message_history),
         )
 
         if not self.message_logger:
@@ -192,18 +377,106 @@ class AnsariClaude(Ansari):
             return
 
         # Validate message structure
-        if not self.validate_message(message):
+        if not trusted and not self.validate_message(message):
             logger.warning(f"Invalid message structure: {message}")
             return
 
-        logger.debug(f"Logging {message}")
+        # Inside _batched_logging(), messages are queued and written together when the block exits
+        if self._pending_log is not None:
+            self._pending_log.append((message, tool_name))
+            self._last_logged_message = message
+            return
+
+        # Lazy %-formatting: repr() of a message with document blocks is large, so only build it if DEBUG is on
+        logger.debug("Logging %s", message)
+        # Earlier messages may still be on their way to the database
+        self._wait_for_log_writes()
         try:
-            self.message_logger.log(message)
-            logger.debug(f"Successfully logged message with role: {message['role']}")
+            self.message_logger.log(message, tool_name=tool_name)
+            self._last_logged_message = message
+            logger.debug("Successfully logged message with role: %s", role)
         except Exception as e:
             logger.error(f"Error logging message: {str(e)}")
             logger.error(f"Message that failed to log: {message}")
 
+    def _get_system_prompt(self):
+        """Return the rendered system prompt, reading each prompt file only once per process.
+
+        In DEV_MODE the file is re-read on every round so prompt edits take effect without a restart.
+        """
+        system_prompt = self._system_prompt_cache.get(self.system_prompt_file)
+        if system_prompt is None or self.settings.DEV_MODE:
+            system_prompt = PromptMgr().bind(self.system_prompt_file).render()
+            self._system_prompt_cache[self.system_prompt_file] = system_prompt
+        return system_prompt
+
+    def _select_model(self):
+        """Return the model for the next round.
+
+        The round that answers a new user question (rather than tool results) mostly decides which tools to call,
+        so it goes to ANTHROPIC_ROUTING_MODEL when one is configured. Every other round uses ANTHROPIC_MODEL.
+
+        Trade-offs of a routing model: when Claude answers a question without calling any tools, the routing
+        model writes the final answer. The API's prompt cache is per model, so the round after the tool calls
+        can't reuse what the routing round wrote to the cache.
+        """
+        routing_model = self.settings.ANTHROPIC_ROUTING_MODEL
+        if routing_model and self.message_history:
+            last_message = self.message_history[-1]
+            content = last_message.get("content")
+            if last_message.get("role") == "user" and not (
+                isinstance(content, list)
+                and any(isinstance(block, dict) and block.get("type") == "tool_result" for block in content)
+            ):
+                return routing_model
+        return self.settings.ANTHROPIC_MODEL
+
+    @contextmanager
+    def _batched_logging(self):
+        """Queue the messages logged inside this block and write them with a single message_logger call.
+
+        A round that uses tools logs both the assistant tool_use message and the tool_result message;
+        batching turns those into one database update instead of one per message. The update runs on the
+        background log writer; process_message_history waits for it before the turn ends.
+        """
+        self._pending_log = []
+        try:
+            yield
+        finally:
+            pending, self._pending_log = self._pending_log, None
+            if pending:
+                logger.debug("Logging %d queued messages", len(pending))
+                # The next round may repair or normalize these messages in place while the writer encodes them,
+                # so the writer gets its own copies
+                snapshot = [(self._snapshot_for_log(message), tool_name) for message, tool_name in pending]
+                self._log_write = self._log_executor.submit(self._write_log_batch, snapshot)
+
+    @staticmethod
+    def _snapshot_for_log(message):
+        """Copy a message down to its content blocks, the levels that history repairs and normalization edit in place."""
+        content = message.get("content")
+        if isinstance(content, list):
+            content = [dict(block) if isinstance(block, dict) else block for block in content]
+        return {**message, "content": content}
+
+    def _write_log_batch(self, pending):
+        """Write a batch of (message, tool_name) pairs queued by _batched_logging() to the message logger."""
+        try:
+            if hasattr(self.message_logger, "log_many"):
+                self.message_logger.log_many(pending)
+            else:
+                for message, tool_name in pending:
+                    self.message_logger.log(message, tool_name=tool_name)
+        except Exception as e:
+            logger.error(f"Error logging messages: {str(e)}")
+            logger.error(f"Messages that failed to log: {pending}")
+
+    def _wait_for_log_writes(self):
+        """Block until the messages handed to the background log writer are in the database."""
+        if self._log_write is not None:
+            self._log_write.result()
+            self._log_write = None
+
     def process_input(self, user_input: str):
         """Process user input and generate a response."""
         logger.debug(f"Processing input: {user_input}")
@@ -223,9 +496,22 @@ class AnsariClaude(Ansari):
         Replaces the current message history (stored in Ansari) with the given message history,
         and then processes it to generate a response from Ansari.
         """
+        self._load_message_history(message_history)
+
+        # Yield Ansari's response to the user
+        for m in self.process_message_history(use_tool):
+            if m:
+                yield m
+
+    def _load_message_history(self, message_history: list[dict]):
+        """Replace the message history with a cleaned copy of `message_history` and reset the tool usage history."""
         # Reset tool usage history for each message history replacement
         self.tool_usage_history = []
         self.tool_calls_with_args = []
+        # A replaced history is a new conversation, so citation numbering starts over
+        self.citations = []
+        self._citation_renders = {}
+        self._turn_citations_start = 0
         logger.debug("Reset tool usage history for message history replacement")
         # AnsariClaude doesn't use system message, so we don't need to prefix it
         # Remove message IDs from the history before sending to Claude
@@ -234,15 +520,18 @@ class AnsariClaude(Ansari):
             msg_copy = msg.copy()
             if "id" in msg_copy:
                 del msg_copy["id"]
+            # Messages decoded from the database/request carry their own copy of every role and block type
+            # string; intern them so a long history shares one object per value (as agent-built messages do)
+            if isinstance(role := msg_copy.get("role"), str):
+                msg_copy["role"] = sys.intern(role)
+            if isinstance(content := msg_copy.get("content"), list):
+                for block in content:
+                    if isinstance(block, dict) and isinstance(block_type := block.get("type"), str):
+                        block["type"] = sys.intern(block_type)
             cleaned_history.append(msg_copy)
 
         self.message_history = cleaned_history
 
-        # Yield Ansari's response to the user
-        for m in self.process_message_history(use_tool):
-            if m:
-                yield m
-
     def _convert_tool_format(self, tool):
         """Convert from OpenAI's function calling format to Claude's format.
 
@@ -270,12 +559,20 @@ class AnsariClaude(Ansari):
                 "required": [...]
             }
         }
+
+        Converted tools are cached at the class level, so the conversion only happens once per tool.
         """
-        return {
-            "name": tool["function"]["name"],
-            "description": tool["function"]["description"],
-            "input_schema": tool["function"]["parameters"],
-        }
+        fn = tool["function"]
+        key = (fn["name"], fn["description"])
+        converted = self._claude_tool_cache.get(key)
+        if converted is None:
+            converted = {
+                "name": fn["name"],
+                "description": fn["description"],
+                "input_schema": fn["parameters"],
+            }
+            self._claude_tool_cache[key] = converted
+        return converted
 
     def _validate_message_history(self):
         """
@@ -293,24 +590,58 @@ class AnsariClaude(Ansari):
         # First check if we need any repairs at all
         needs_repair = False
 
-        # Count tool_use blocks without matching tool_result blocks
-        tool_use_ids = set()
-        tool_result_ids = set()
+        # Collect tool_use IDs, tool_result IDs and document-less tool_results in a single pass. Only messages
+        # appended since the previous call are scanned; the IDs collected from earlier ones are kept. If the
+        # history was replaced or edited before the watermark, start over.
+        history = self.message_history
+        start = self._validated_upto
+        if not (0 < start <= len(history) and history[start - 1] is self._validated_last and self._validated_ids is not None):
+            start = 0
+            self._validated_ids = (set(), set(), [])
+        tool_use_ids, tool_result_ids, missing_document_ids = self._validated_ids
+
+        for msg in islice(history, start, None):
+            role = msg.get("role")
+            content = msg.get("content")
+            if not isinstance(content, list):
+                continue
 
-        # Collect all tool_use IDs
-        for msg in self.message_history:
-            if msg.get("role") == "assistant" and isinstance(msg.get("content"), list):
-                for block in msg["content"]:
+            if role == "assistant":
+                for block in content:
                     if isinstance(block, dict) and block.get("type") == "tool_use" and "id" in block:
                         tool_use_ids.add(block["id"])
 
-        # Collect all tool_result IDs
-        for msg in self.message_history:
-            if msg.get("role") == "user" and isinstance(msg.get("content"), list):
-                for block in msg["content"]:
-                    if isinstance(block, dict) and block.get("type") == "tool_result" and "tool_use_id" in block:
+            elif role == "user":
+                # Documents as siblings of the tool_result (old format) count for every tool_result in the message
+                has_sibling_document = None
+                for block in content:
+                    if not isinstance(block, dict) or block.get("type") != "tool_result":
+                        continue
+                    if "tool_use_id" in block:
                         tool_result_ids.add(block["tool_use_id"])
 
+                    # Skip error tool_results — they intentionally have no documents
+                    # Skip tool_results with no content — valid for no-results cases
+                    if block.get("is_error") or "content" not in block:
+                        continue
+
+                    # Check for documents as siblings (old format) or
+                    # nested inside tool_result.content (current format)
+                    if has_sibling_document is None:
+                        has_sibling_document = any(isinstance(b, dict) and b.get("type") == "document" for b in content)
+                    has_document = has_sibling_document
+                    if not has_document:
+                        tool_content = block["content"]
+                        if isinstance(tool_content, list):
+                            has_document = any(
+                                isinstance(item, dict) and item.get("type") == "document" for item in tool_content
+                            )
+                    if not has_document:
+                        missing_document_ids.append(block.get("tool_use_id"))
+
+        self._validated_upto = len(history)
+        self._validated_last = history[-1] if history else None
+
         # Check for missing tool_result blocks
         missing_results = tool_use_ids - tool_result_ids
         if missing_results:
@@ -318,34 +649,16 @@ class AnsariClaude(Ansari):
             needs_repair = True
 
         # Check for tool_result blocks without document blocks
-        for msg in self.message_history:
-            if msg.get("role") == "user" and isinstance(msg.get("content"), list):
-                for block in msg["content"]:
-                    if isinstance(block, dict) and block.get("type") == "tool_result":
-                        # Skip error tool_results — they intentionally have no documents
-                        if block.get("is_error"):
-                            continue
-                        # Skip tool_results with no content — valid for no-results cases
-                        if "content" not in block:
-                            continue
-                        # Check for documents as siblings (old format) or
-                        # nested inside tool_result.content (current format)
-                        has_document = any(isinstance(b, dict) and b.get("type") == "document" for b in msg["content"])
-                        if not has_document:
-                            tool_content = block.get("content", [])
-                            if isinstance(tool_content, list):
-                                has_document = any(
-                                    isinstance(item, dict) and item.get("type") == "document" for item in tool_content
-                                )
-                        if not has_document:
-                            logger.warning(f"Found tool_result without document block: {block.get('tool_use_id')}")
-                            needs_repair = True
-                            break
+        for tool_use_id in missing_document_ids:
+            logger.warning(f"Found tool_result without document block: {tool_use_id}")
+            needs_repair = True
 
         # If any issue was found, do a full repair
         if needs_repair:
             logger.debug("Repairing message history before sending to Claude API")
             self._fix_tool_use_result_relationship()
+            # The repair rewrites earlier messages, so the next call has to scan everything again
+            self._validated_upto = 0
 
     def _check_tool_limit(self, current_tool_name, current_tool_args=None):
         """
@@ -458,6 +771,18 @@ class AnsariClaude(Ansari):
 
     def process_tool_call(self, tool_name: str, tool_args: dict, tool_id: str):
         """Process a tool call and return its result as a list."""
+        prepared = self._prepare_tool_call(tool_name, tool_args, tool_id)
+        if len(prepared) == 3:
+            return prepared
+        tool_instance, query = prepared
+        return self._run_tool(tool_name, tool_instance, query)
+
+    def _prepare_tool_call(self, tool_name: str, tool_args: dict, tool_id: str):
+        """Check the tool usage limits, record the call and resolve its tool instance and query.
+
+        Returns:
+            (tool_instance, query) if the tool should be run, or an error tuple (message, None, True).
+        """
         # Check if we need to force an answer due to tool usage patterns BEFORE tracking this tool
         # This prevents counting the current tool if we're already at the limit
         if self._check_tool_limit(tool_name, tool_args):
@@ -475,9 +800,10 @@ class AnsariClaude(Ansari):
         self.tool_usage_history.append(tool_name)
         # Also track the tool arguments
         self.tool_calls_with_args.append({"tool": tool_name, "args": tool_args, "tool_id": tool_id})
-        logger.debug(f"Tool usage history: {self.tool_usage_history}")
+        logger.debug("Tool usage history: %s", self.tool_usage_history)
 
-        if tool_name not in self.tool_name_to_instance:
+        tool_instance = self.tool_name_to_instance.get(tool_name)
+        if tool_instance is None:
             logger.warning(f"Unknown tool name: {tool_name}")
             error_message = f"Unknown tool: {tool_name}"
             # Return as error tuple to avoid citation consistency issues
@@ -492,9 +818,14 @@ class AnsariClaude(Ansari):
             # Return as error tuple to avoid citation consistency issues
             return (error_message, None, True)
 
-        try:
-            tool_instance = self.tool_name_to_instance[tool_name]
+        return (tool_instance, query)
+
+    def _run_tool(self, tool_name: str, tool_instance, query: str):
+        """Run a prepared tool call and format its results.
 
+        This only touches the tool instance (no agent state), so it is safe to call from worker threads.
+        """
+        try:
             # Get raw results
             results = tool_instance.run(query)
 
@@ -628,59 +959,79 @@ class AnsariClaude(Ansari):
         else:
             return ""
 
-    def process_one_round(self) -> Generator[str, None, None]:
-        """Process one round of conversation.
-
-        Yields:
-            Chunks of the response text
+    def _call_claude_api(self, params: dict):
+        """Start the streaming Messages API request, retrying transient failures with exponential backoff.
 
-        Side effect:
-            - Updates the message history with at most one user message and one assistant message
-            - Logs these messages once they're complete
+        This is the only retry layer for API calls: if it gives up, the error propagates to
+        process_message_history, which ends the turn with an error message instead of retrying again.
         """
-        # ======================================================================
-        # 1. API REQUEST PREPARATION AND EXECUTION
-        # ======================================================================
-        prompt_mgr = PromptMgr()
-        system_prompt = prompt_mgr.bind(self.system_prompt_file).render()
+        start_time = time.time()
+
+        def log_retry(retry_state):
+            e = retry_state.outcome.exception()
+            logger.warning(
+                f"API call failed after {time.time() - start_time:.2f}s ({type(e).__name__}: {e}), "
+                f"retrying in {retry_state.next_action.sleep:.2f}s"
+            )
+
+        retrying = Retrying(
+            stop=stop_after_attempt(self.settings.MAX_FAILURES),
+            wait=_api_retry_wait,
+            retry=retry_if_exception(_is_retryable_api_error),
+            before_sleep=log_retry,
+            sleep=time.sleep,
+            reraise=True,
+        )
+
+        try:
+            logger.debug("Calling Anthropic API...")
+            response = retrying(self.client.messages.create, **params)
+        except Exception as e:
+            logger.error(f"API call failed after {time.time() - start_time:.2f}s: {str(e)}")
+            logger.error(f"Error type: {type(e).__name__}")
+
+            if hasattr(e, "__dict__"):
+                logger.error(f"Error details: {e.__dict__}")
+
+            # If in DEV_MODE, dump message history to file
+            if get_settings().DEV_MODE:
+                json_file_path = "./logs/last_err_msg_hist.json"
+                with open(json_file_path, "w") as f:
+                    json.dump(self.message_history, f, indent=4)
+                logger.debug(f"Dumped message history to {json_file_path}")
+            raise
+
+        logger.debug(f"API connection established after {time.time() - start_time:.2f}s")
+        return response
+
+    def _build_request_params(self) -> dict:
+        """Validate the message history and build the parameters of the next Messages API request from it."""
+        system_prompt = self._get_system_prompt()
 
         # Run pre-flight validation to ensure proper tool_use/tool_result relationship
         # This helps prevent API errors by fixing message structure before sending
         self._validate_message_history()
 
-        # Log the final message history before sending to API
-        logger.debug(f"Sending messages to Claude: {json.dumps(self.message_history, indent=2)}")
+        # Log the final message history before sending to API (serializing it is costly, so only when debugging)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Sending messages to Claude: %s", json.dumps(self.message_history, indent=2))
 
         # Limit documents in message history to prevent Claude from crashing
         # This creates a copy of the message history, preserving the original
         limited_history = self.limit_documents_in_message_history(max_documents=100)
 
-        # Add cache control to ONLY the LAST content block of the last message for prompt caching optimization
+        # Add cache control to the LAST content block of the last message for prompt caching optimization.
+        # The message before it gets a second breakpoint: the API only looks back about 20 content blocks from a
+        # breakpoint for an earlier cache entry, and a tool_result full of documents can push the previous
+        # request's breakpoint out of that window. (System prompt + these two stay within the limit of 4.)
         if limited_history and len(limited_history) > 0:
-            last_message = limited_history[-1]
-            # Add cache control only to the LAST content block in the last message
-            if isinstance(last_message.get("content"), list) and len(last_message["content"]) > 0:
-                # Only add to the last block
-                last_block = last_message["content"][-1]
-                if isinstance(last_block, dict):
-                    # Add ephemeral cache control to only the last content block
-                    last_block["cache_control"] = {"type": "ephemeral"}
-                logger.debug(
-                    f"Added ephemeral cache control to last content block of last message "
-                    f"with role: {last_message.get('role')}"
-                )
-            elif isinstance(last_message.get("content"), str):
-                # If content is a string, convert to list format with cache control
-                last_message["content"] = [
-                    {"type": "text", "text": last_message["content"], "cache_control": {"type": "ephemeral"}}
-                ]
-                logger.debug(
-                    f"Converted string content to list format with cache control for role: {last_message.get('role')}"
-                )
+            self._add_cache_breakpoint(limited_history, -1)
+            if len(limited_history) > 1:
+                self._add_cache_breakpoint(limited_history, -2)
 
         # Create API request parameters with the limited history
         params = {
-            "model": self.settings.ANTHROPIC_MODEL,
+            "model": self._select_model(),
             "system": [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}],
             "messages": limited_history,  # Use the limited version for API call
             "max_tokens": 4096,
@@ -689,77 +1040,55 @@ class AnsariClaude(Ansari):
         }
         params["tools"] = self.tools
 
-        # Count documents in original vs limited history for logging
-        orig_doc_count = sum(
-            sum(1 for block in msg.get("content", []) if isinstance(block, dict) and block.get("type") == "document")
-            for msg in self.message_history
-            if isinstance(msg.get("content"), list)
-        )
-        limited_doc_count = sum(
-            sum(1 for block in msg.get("content", []) if isinstance(block, dict) and block.get("type") == "document")
-            for msg in limited_history
-            if isinstance(msg.get("content"), list)
-        )
+        # The document counts below scan every block of both histories and only feed a debug line, so skip them
+        # (and formatting the request parameters) unless debug logging is enabled
+        if logger.isEnabledFor(logging.DEBUG):
+            # Count documents in original vs limited history for logging
+            orig_doc_count = sum(
+                sum(1 for block in msg.get("content", []) if isinstance(block, dict) and block.get("type") == "document")
+                for msg in self.message_history
+                if isinstance(msg.get("content"), list)
+            )
+            limited_doc_count = sum(
+                sum(1 for block in msg.get("content", []) if isinstance(block, dict) and block.get("type") == "document")
+                for msg in limited_history
+                if isinstance(msg.get("content"), list)
+            )
 
-        # Log API request parameters (excluding the full message history for brevity)
-        logger_params = params.copy()
-        doc_info = f"[{len(self.message_history)} messages with {limited_doc_count} documents"
-        if orig_doc_count != limited_doc_count:
-            doc_info += f", limited from {orig_doc_count} documents]"
-        else:
-            doc_info += "]"
-        logger_params["messages"] = doc_info
-        logger_params["system"] = system_prompt[:100] + "..." if len(system_prompt) > 100 else system_prompt
-        logger.debug(f"API request parameters: {logger_params}")
+            # Log API request parameters (excluding the full message history for brevity)
+            logger_params = params.copy()
+            doc_info = f"[{len(self.message_history)} messages with {limited_doc_count} documents"
+            if orig_doc_count != limited_doc_count:
+                doc_info += f", limited from {orig_doc_count} documents]"
+            else:
+                doc_info += "]"
+            logger_params["messages"] = doc_info
+            logger_params["system"] = system_prompt[:100] + "..." if len(system_prompt) > 100 else system_prompt
+            logger.debug(f"API request parameters: {logger_params}")
 
-        failures = 0
-        response = None
-        start_time = time.time()
+        return params
 
-        # Retry loop for API calls
-        while not response:
-            try:
-                logger.debug("Calling Anthropic API...")
-                response = self.client.messages.create(**params)
-                elapsed = time.time() - start_time
-                logger.debug(f"API connection established after {elapsed:.2f}s")
-            except Exception as e:
-                failures += 1
-                elapsed = time.time() - start_time
-                logger.warning(f"API call failed after {elapsed:.2f}s: {str(e)}")
-                logger.error(f"Error type: {type(e).__name__}")
-
-                if hasattr(e, "__dict__"):
-                    logger.error(f"Error details: {e.__dict__}")
-
-                # If in DEV_MODE and it's the first failure, dump message history to file
-                if get_settings().DEV_MODE and failures == 1:
-                    json_file_path = "./logs/last_err_msg_hist.json"
-                    with open(json_file_path, "w") as f:
-                        json.dump(self.message_history, f, indent=4)
-                    logger.debug(f"Dumped message history to {json_file_path}")
-
-                if failures >= self.settings.MAX_FAILURES:
-                    logger.error("Max retries exceeded")
-                    raise
-
-                logger.debug("Retrying in 5 seconds...")
-                time.sleep(5)
-                continue
+    def process_one_round(self) -> Generator[str, None, None]:
+        """Process one round of conversation.
+
+        Yields:
+            Chunks of the response text
 
+        Side effect:
+            - Updates the message history with at most one user message and one assistant message
+            - Logs these messages once they're complete
+        """
         # ======================================================================
-        # 2. INITIALIZE STATE VARIABLES
+        # 1. API REQUEST PREPARATION AND EXECUTION
         # ======================================================================
-        # Variables to accumulate complete messages before adding to history
-        assistant_text = ""  # Accumulated assistant response text
-        tool_calls = []  # List of complete tool calls
-        response_finished = False  # Flag to prevent duplicate processing
-
-        # Variables for processing the streaming response
-        current_tool = None  # Current tool being processed
-        current_json = ""  # Accumulated JSON for current tool
+        params = self._build_request_params()
+        response = self._call_claude_api(params)
 
-        logger.debug("Processing response chunks")
+        # ======================================================================
+        # 2. INITIALIZE STATE VARIABLES
+        # ======================================================================
+        state = _StreamState()
+        self._started_tool_calls = {}  # Tool calls already running, see _start_tool_call
 
         """ Warning: This is probably the most complex code in all of Ansari.
 
@@ -775,206 +1104,198 @@ class AnsariClaude(Ansari):
 
         """
         logger.debug("Starting to process response stream")
-        chunk_count = 0
-        content_block_count = 0
-        message_delta_count = 0
 
         # ======================================================================
         # 3. PROCESS STREAMING RESPONSE (STATE MACHINE)
         # ======================================================================
-        # This is a finite state machine that processes different types of chunks:
+        # This is a finite state machine that processes different types of chunks, one handler per type
+        # (see _chunk_handlers):
         # - content_block_start: Start of a content block (text or tool_use)
         # - content_block_delta: Updates to content (text, citations, tool JSON)
         # - content_block_stop: End of a content block
         # - message_delta: Top-level message updates, including termination
         # - message_stop: Final message termination
+        get_handler = self._chunk_handlers.get
         for chunk in response:
-            chunk_count += 1
-            logger.debug(f"Processing chunk #{chunk_count} of type: {chunk.type}")
-
-            if chunk.type == "content_block_start":
-                content_block_count += 1
-                logger.debug(f"Content block #{content_block_count} start: {getattr(chunk.content_block, 'type', 'unknown')}")
-
-                if (
-                    hasattr(chunk, "content_block")
-                    and hasattr(chunk.content_block, "type")
-                    and chunk.content_block.type == "tool_use"
-                ):
-                    # Start of a tool call
-                    logger.debug(f"Starting tool call with id: {chunk.content_block.id}, name: {chunk.content_block.name}")
-                    current_tool = {
-                        "type": "tool_use",
-                        "id": chunk.content_block.id,
-                        "name": chunk.content_block.name,
-                    }
-                    logger.debug(f"Starting tool call: {current_tool}")
-                else:
-                    logger.debug(f"Content block start but not a tool use: {chunk}")
-                    if (newline := self._separate_tool_result_from_preceding_text()) and assistant_text == "":
-                        # If we have a newline to separate, add it to the assistant text
-                        assistant_text += newline
-                        logger.debug(
-                            f"Adding `{newline}` to start of assistant text (to separate it from previous content block)"
-                        )
-
-            elif chunk.type == "content_block_delta":
-                if hasattr(chunk.delta, "text"):
-                    text = chunk.delta.text
-                    assistant_text += text
-                    logger.debug(f"Adding text delta: '{text[:20]}...' (truncated)")
-                    yield text
-                elif getattr(chunk.delta, "type", None) == "citations_delta":
-                    # Process citation delta
-                    citation = chunk.delta.citation
-                    self.citations.append(citation)
-                    citation_ref = f" [{len(self.citations)}] "
-                    assistant_text += citation_ref
-                    logger.debug(f"Adding citation reference: {citation_ref}")
-                    yield citation_ref
-                elif hasattr(chunk.delta, "partial_json"):
-                    # Accumulate JSON for tool arguments
-                    current_json += chunk.delta.partial_json
-                    logger.debug(f"Accumulating JSON for tool, current length: {len(current_json)}")
-                else:
-                    logger.debug(f"Unhandled content_block_delta: {chunk.delta}")
-
-            elif chunk.type == "content_block_stop":
-                logger.debug("Content block stop received")
-                if current_tool:
-                    try:
-                        logger.debug(f"Parsing accumulated JSON for tool: {current_json[:50]}... (truncated)")
-                        arguments = json.loads(current_json)
-                        logger.debug(f"Tool arguments: {arguments}")
-                        current_tool["input"] = arguments
-                        tool_calls.append(current_tool)
-                        logger.debug(f"Added tool call to queue, total: {len(tool_calls)}")
+            state.chunk_count += 1
+            chunk_type = chunk.type
+            logger.debug("Processing chunk #%d of type: %s", state.chunk_count, chunk_type)
+
+            handler = get_handler(chunk_type)
+            if handler is not None:
+                yield from handler(self, chunk, state)
+
+        # Yield whatever is still buffered if the stream ended without a final stop chunk
+        if out := state.text_buffer.flush():
+            yield out
+
+    def _on_message_start(self, chunk, state):
+        """Handle the message_start chunk, logging how much of the prompt was served from the prompt cache."""
+        usage = getattr(chunk.message, "usage", None)
+        if usage is not None:
+            logger.debug(
+                "Prompt cache usage: %s tokens read, %s tokens written, %s uncached input tokens",
+                getattr(usage, "cache_read_input_tokens", None),
+                getattr(usage, "cache_creation_input_tokens", None),
+                getattr(usage, "input_tokens", None),
+            )
+        return ()
+
+    def _on_content_block_start(self, chunk, state):
+        """Handle a content_block_start chunk: begin a tool call, or a text block."""
+        state.content_block_count += 1
+        content_block = chunk.content_block
+        logger.debug("Content block #%d start: %s", state.content_block_count, content_block.type)
+
+        if content_block.type == "tool_use":
+            # Start of a tool call
+            logger.debug("Starting tool call with id: %s, name: %s", content_block.id, content_block.name)
+            state.current_tool = {
+                "type": "tool_use",
+                "id": content_block.id,
+                "name": content_block.name,
+            }
+            logger.debug("Starting tool call: %s", state.current_tool)
+        else:
+            logger.debug("Content block start but not a tool use: %s", chunk)
+            if (newline := self._separate_tool_result_from_preceding_text()) and not state.text_parts:
+                # If we have a newline to separate, add it to the assistant text
+                state.text_parts.append(newline)
+                logger.debug("Adding `%s` to start of assistant text (to separate it from previous content block)", newline)
+        return ()
+
+    def _on_content_block_delta(self, chunk, state):
+        """Handle a content_block_delta chunk: text, a citation, or a fragment of tool arguments."""
+        delta = chunk.delta
+        delta_type = delta.type
+        if delta_type == "text_delta":
+            text = delta.text
+            if not text:
+                # Empty deltas carry nothing to record or yield
+                return
+            state.text_parts.append(text)
+            logger.debug("Adding text delta: '%.20s...' (truncated)", text)
+            if out := state.text_buffer.add(text):
+                yield out
+        elif delta_type == "citations_delta":
+            # Process citation delta
+            citation = delta.citation
+            self.citations.append(citation)
+            number = self._turn_citations_start + len(self.citations)
+            # Render the citation (which may need a translation) while the rest of the response streams in
+            if self._citation_renders is None:
+                self._citation_renders = {}
+            self._citation_renders[number] = self._citation_executor.submit(self._format_citation, number, citation)
+            citation_ref = f" [{number}] "
+            state.text_parts.append(citation_ref)
+            logger.debug("Adding citation reference: %s", citation_ref)
+            # Citation references are yielded right away (with any text buffered before them). add() may already
+            # have released the buffer, in which case flush() returns "" and its result must not be dropped.
+            if out := state.text_buffer.add(citation_ref) + state.text_buffer.flush():
+                yield out
+        elif delta_type == "input_json_delta":
+            # Accumulate JSON for tool arguments
+            state.json_parts.append(delta.partial_json)
+            logger.debug("Accumulating JSON for tool, fragments so far: %d", len(state.json_parts))
+        else:
+            logger.debug("Unhandled content_block_delta: %s", delta)
+
+    def _on_content_block_stop(self, chunk, state):
+        """Handle a content_block_stop chunk: complete the current tool call, if any, and start running it."""
+        logger.debug("Content block stop received")
+        if out := state.text_buffer.flush():
+            yield out
+        if state.current_tool:
+            current_json = "".join(state.json_parts)
+            try:
+                logger.debug("Parsing accumulated JSON for tool: %.50s... (truncated)", current_json)
+                arguments = json.loads(current_json)
+                logger.debug("Tool arguments: %s", arguments)
+                state.current_tool["input"] = arguments
+                state.tool_calls.append(state.current_tool)
+                logger.debug("Added tool call to queue, total: %d", len(state.tool_calls))
 
-                        # Reset for next tool
-                        current_tool = None
-                        current_json = ""
+                # Its arguments are complete, so start the search while the rest of the turn streams in
+                self._start_tool_call(state.current_tool)
 
-                    except Exception as e:
-                        error_msg = f"Tool call failed: {str(e)}"
-                        logger.error(error_msg)
-                        logger.error(f"Failed JSON: {current_json}")
-                        raise
-
-            elif chunk.type == "message_delta":
-                message_delta_count += 1
-                logger.debug(f"Message delta #{message_delta_count} received")
-
-                if hasattr(chunk.delta, "stop_reason"):
-                    logger.debug(f"Message delta has stop_reason: {chunk.delta.stop_reason}")
-                    # Both stop reasons need different handling
-                    if chunk.delta.stop_reason in ["end_turn", "tool_use"]:
-                        if response_finished:
-                            stop_reason = chunk.delta.stop_reason
-                            logger.warning(f"Received {stop_reason} stop_reason but response already finished - skipping")
-                        else:
-                            logger.debug(f"Message delta has stop_reason {chunk.delta.stop_reason}")
-
-                            if chunk.delta.stop_reason == "end_turn":
-                                # For end_turn, create a final assistant message with text and tool calls
-                                citations_text = self._finish_response(assistant_text, tool_calls)
-                                if citations_text:
-                                    yield citations_text
-
-                                # Process any tool calls - the tool use is already in the assistant message
-                                try:
-                                    self._process_tool_calls(tool_calls)
-                                except Exception as e:
-                                    logger.error(f"Error in tool call processing: {str(e)}")
-                                    # Track in Sentry
-                                    if get_settings().SENTRY_DSN:
-                                        sentry_sdk.set_tag("error_type", "tool_processing_failure")
-                                        sentry_sdk.capture_exception(e)
-
-                            elif chunk.delta.stop_reason == "tool_use" and tool_calls:
-                                # For tool_use, we need to create an assistant message with JUST the tool
-                                # This is critical to maintain the tool_use -> tool_result relationship
-                                logger.debug("Adding assistant message with tool_use (no text content)")
-
-                                # Create content blocks with only the tool_use blocks
-                                tool_content = []
-                                for tc in tool_calls:
-                                    tool_content.append(tc)
-
-                                # Add assistant message with just tool_use (no text block)
-                                assistant_message = {"role": "assistant", "content": tool_content}
-
-                                # Add to message history
-                                self.message_history.append(assistant_message)
-
-                                # For logging, add tool_name
-                                log_message = assistant_message.copy()
-                                if tool_calls:
-                                    log_message["tool_name"] = tool_calls[0]["name"]
-                                self._log_message(log_message)
-
-                                # Now process the tool calls
-                                try:
-                                    self._process_tool_calls(tool_calls)
-                                except Exception as e:
-                                    logger.error(f"Error in tool call processing: {str(e)}")
-                                    # Track in Sentry
-                                    if get_settings().SENTRY_DSN:
-                                        sentry_sdk.set_tag("error_type", "tool_processing_failure")
-                                        sentry_sdk.capture_exception(e)
-
-                            # Mark as finished to prevent duplicate processing
-                            response_finished = True
-                elif hasattr(chunk.delta, "text"):
-                    text = chunk.delta.text
-                    assistant_text += text
-                    logger.debug(f"Adding message delta text: '{text[:20]}...' (truncated)")
-                    yield text
-                else:
-                    logger.debug(f"Unhandled message_delta: {chunk.delta}")
+                # Reset for next tool
+                state.current_tool = None
+                state.json_parts = []
 
-            elif chunk.type == "message_stop":
-                if response_finished:
-                    logger.debug("Received message_stop but response already finished - skipping")
+            except Exception as e:
+                error_msg = f"Tool call failed: {str(e)}"
+                logger.error(error_msg)
+                logger.error(f"Failed JSON: {current_json}")
+                raise
+
+    def _on_message_delta(self, chunk, state):
+        """Handle a message_delta chunk, finishing the response when it carries a stop_reason."""
+        state.message_delta_count += 1
+        logger.debug("Message delta #%d received", state.message_delta_count)
+        if out := state.text_buffer.flush():
+            yield out
+
+        stop_reason = chunk.delta.stop_reason
+        if stop_reason:
+            logger.debug("Message delta has stop_reason: %s", stop_reason)
+            # Both stop reasons need different handling
+            if stop_reason in ("end_turn", "tool_use"):
+                if state.response_finished:
+                    logger.warning(f"Received {stop_reason} stop_reason but response already finished - skipping")
                 else:
-                    logger.debug("Message_stop chunk received - finishing response")
+                    logger.debug("Message delta has stop_reason %s", stop_reason)
 
-                    if assistant_text:
-                        # If we have text content, create a complete assistant message with text and tools
-                        citations_text = self._finish_response(assistant_text, tool_calls)
+                    if stop_reason == "end_turn":
+                        # For end_turn, create a final assistant message with text and tool calls
+                        # (_finish_response also runs any tool calls, the tool use being part of that message)
+                        citations_text = self._finish_response("".join(state.text_parts), state.tool_calls)
                         if citations_text:
                             yield citations_text
-                    elif tool_calls:
-                        # If we only have tool calls and no text, create an assistant message with JUST tools
-                        # This avoids empty text blocks but maintains tool_use -> tool_result relationship
-                        logger.debug("Creating assistant message with just tool calls (no text)")
-
-                        # Create content with only the tool_use blocks
-                        tool_content = []
-                        for tc in tool_calls:
-                            tool_content.append(tc)
-
-                        # Add assistant message with just tool_use (no text block)
-                        assistant_message = {"role": "assistant", "content": tool_content}
-
-                        # Add to message history
-                        self.message_history.append(assistant_message)
-
-                        # For logging, add tool_name
-                        log_message = assistant_message.copy()
-                        log_message["tool_name"] = tool_calls[0]["name"]
-                        self._log_message(log_message)
-
-                        # Process the tool calls
-                        try:
-                            self._process_tool_calls(tool_calls)
-                        except Exception as e:
-                            logger.error(f"Error in tool call processing: {str(e)}")
-                            # Track in Sentry
-                            if get_settings().SENTRY_DSN:
-                                sentry_sdk.set_tag("error_type", "tool_processing_failure")
-                                sentry_sdk.capture_exception(e)
-
-                    response_finished = True
+
+                    elif stop_reason == "tool_use" and state.tool_calls:
+                        # For tool_use, we need to create an assistant message with JUST the tool
+                        # This is critical to maintain the tool_use -> tool_result relationship
+                        logger.debug("Adding assistant message with tool_use (no text content)")
+                        self._add_tool_use_message(state.tool_calls)
+
+                    # Mark as finished to prevent duplicate processing
+                    state.response_finished = True
+        else:
+            # message_delta events only carry stop_reason/stop_sequence/usage; text arrives as content_block_delta
+            logger.debug("Unhandled message_delta: %s", chunk.delta)
+
+    def _on_message_stop(self, chunk, state):
+        """Handle the message_stop chunk, finishing the response unless a message_delta already did."""
+        if out := state.text_buffer.flush():
+            yield out
+        if state.response_finished:
+            logger.debug("Received message_stop but response already finished - skipping")
+        else:
+            logger.debug("Message_stop chunk received - finishing response")
+
+            if assistant_text := "".join(state.text_parts):
+                # If we have text content, create a complete assistant message with text and tools
+                citations_text = self._finish_response(assistant_text, state.tool_calls)
+                if citations_text:
+                    yield citations_text
+            elif state.tool_calls:
+                # If we only have tool calls and no text, create an assistant message with JUST tools
+                # This avoids empty text blocks but maintains tool_use -> tool_result relationship
+                logger.debug("Creating assistant message with just tool calls (no text)")
+                self._add_tool_use_message(state.tool_calls)
+
+            state.response_finished = True
+
+    # Streamed chunk type -> handler(self, chunk, state), each returning an iterable of text to yield to the caller.
+    # Other chunk types (e.g. ping) carry nothing we use and are skipped.
+    _chunk_handlers = {
+        "message_start": _on_message_start,
+        "content_block_start": _on_content_block_start,
+        "content_block_delta": _on_content_block_delta,
+        "content_block_stop": _on_content_block_stop,
+        "message_delta": _on_message_delta,
+        "message_stop": _on_message_stop,
+    }
 
     def _fix_tool_use_result_relationship(self):
         """
@@ -995,7 +1316,7 @@ class AnsariClaude(Ansari):
                     if isinstance(block, dict) and block.get("type") == "tool_use" and "id" in block:
                         tool_id = block["id"]
                         tool_use_info[tool_id] = (msg_idx, block)
-                        logger.debug(f"Found tool_use block with ID {tool_id} at message index {msg_idx}")
+                        logger.debug("Found tool_use block with ID %s at message index %d", tool_id, msg_idx)
 
         # 2. Check which tool_use IDs have corresponding tool_result blocks
         tool_result_info = {}  # Maps tool ID to message_idx
@@ -1005,7 +1326,7 @@ class AnsariClaude(Ansari):
                     if isinstance(block, dict) and block.get("type") == "tool_result" and "tool_use_id" in block:
                         tool_id = block["tool_use_id"]
                         tool_result_info[tool_id] = msg_idx
-                        logger.debug(f"Found tool_result block with ID {tool_id} at message index {msg_idx}")
+                        logger.debug("Found tool_result block with ID %s at message index %d", tool_id, msg_idx)
 
         # 3. Create fallback tool_result blocks for any tool_use without a result
         for tool_id, (msg_idx, tool_block) in tool_use_info.items():
@@ -1103,6 +1424,29 @@ class AnsariClaude(Ansari):
 
         logger.debug("Completed tool_use/tool_result relationship fix")
 
+    def _add_tool_use_message(self, tool_calls):
+        """Add an assistant message holding only the tool_use blocks, then run the tool calls.
+
+        The message content is built in one go and the message is appended and logged once, after which the
+        tool results are added as a single user message by _process_tool_calls.
+        """
+        # Add assistant message with just tool_use (no text block)
+        assistant_message = {"role": "assistant", "content": list(tool_calls)}
+        self.message_history.append(assistant_message)
+
+        # For logging, add tool_name
+        self._log_message(assistant_message, tool_name=tool_calls[0]["name"], trusted=True)
+
+        # Now process the tool calls
+        try:
+            self._process_tool_calls(tool_calls)
+        except Exception as e:
+            logger.error(f"Error in tool call processing: {str(e)}")
+            # Track in Sentry
+            if get_settings().SENTRY_DSN:
+                sentry_sdk.set_tag("error_type", "tool_processing_failure")
+                sentry_sdk.capture_exception(e)
+
     def _process_tool_calls(self, tool_calls):
         """Process a list of tool calls and add results to message history.
 
@@ -1122,68 +1466,11 @@ class AnsariClaude(Ansari):
         # Collect all tool results into a single content array
         all_tool_result_content = []
 
-        for tc in tool_calls:
-            try:
-                # Process the tool call
-                result = self.process_tool_call(tc["name"], tc["input"], tc["id"])
-
-                # Check if this is an error return (3-tuple) vs success (2-tuple)
-                if len(result) == 3:
-                    # Error case: (message, None, is_error)
-                    error_message, _, _ = result
-                    logger.debug(f"Tool {tc['name']} returned error: {error_message}")
-                    all_tool_result_content.append(
-                        {
-                            "type": "tool_result",
-                            "tool_use_id": tc["id"],
-                            "content": error_message,
-                            "is_error": True,
-                        }
-                    )
-                    continue  # Skip document processing for errors
-
-                # Success case: (tool_result, reference_list)
-                tool_result, reference_list = result
-                logger.debug(f"Reference list: {json.dumps(reference_list, indent=2)}")
-
-                # Process references - ALWAYS apply special formatting
-                document_blocks = []
-                if reference_list and len(reference_list) > 0:
-                    document_blocks = copy.deepcopy(reference_list)
-
-                    # Always apply special processing for all tools
-                    for doc in document_blocks:
-                        if "source" in doc and "data" in doc["source"]:
-                            # Use the robust document processing function
-                            processed_doc = process_document_source_data(doc)
-
-                            # Update the document with the processed version
-                            doc.update(processed_doc)
-
-                # If no document blocks, return empty tool_result (no content field needed)
-                if not document_blocks:
-                    logger.warning(f"No document blocks found for tool {tc['name']} - returning empty tool_result")
-                    all_tool_result_content.append(
-                        {
-                            "type": "tool_result",
-                            "tool_use_id": tc["id"],
-                        }
-                    )
-                else:
-                    # Add tool_result with document blocks INSIDE content (per Anthropic API spec)
-                    tool_result_content = [{"type": "text", "text": "Please see the references below."}]
-                    tool_result_content.extend(document_blocks)
-
-                    all_tool_result_content.append(
-                        {
-                            "type": "tool_result",
-                            "tool_use_id": tc["id"],
-                            "content": tool_result_content,
-                        }
-                    )
-
-            except Exception as e:
-                logger.error(f"Error processing tool call: {str(e)}")
+        for tc, result in zip(tool_calls, self._run_tool_calls(tool_calls)):
+            # Only the tool call itself can fail here (_run_tool_calls hands back its exception), so each
+            # tool_use gets exactly one tool_result without wrapping the message construction in a try
+            if isinstance(result, Exception):
+                logger.error(f"Error processing tool call: {str(result)}")
                 # Track tool errors in Sentry
                 if get_settings().SENTRY_DSN:
                     sentry_sdk.set_tag("error_type", "tool_call_failure")
@@ -1191,7 +1478,7 @@ class AnsariClaude(Ansari):
                     sentry_sdk.set_context(
                         "tool_details", {"tool_id": tc["id"], "tool_name": tc["name"], "tool_input": tc["input"]}
                     )
-                    sentry_sdk.capture_exception(e)
+                    sentry_sdk.capture_exception(result)
 
                 # Add error as tool result with is_error flag
                 all_tool_result_content.append(
@@ -1201,6 +1488,58 @@ class AnsariClaude(Ansari):
                         "is_error": True,
                     }
                 )
+                continue
+
+            # Check if this is an error return (3-tuple) vs success (2-tuple)
+            if len(result) == 3:
+                # Error case: (message, None, is_error)
+                error_message, _, _ = result
+                logger.debug(f"Tool {tc['name']} returned error: {error_message}")
+                all_tool_result_content.append(
+                    {
+                        "type": "tool_result",
+                        "tool_use_id": tc["id"],
+                        "content": error_message,
+                        "is_error": True,
+                    }
+                )
+                continue  # Skip document processing for errors
+
+            # Success case: (tool_result, reference_list)
+            tool_result, reference_list = result
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Reference list: %s", json.dumps(reference_list, indent=2))
+
+            # If no document blocks, return empty tool_result (no content field needed)
+            if not reference_list:
+                logger.warning(f"No document blocks found for tool {tc['name']} - returning empty tool_result")
+                all_tool_result_content.append(
+                    {
+                        "type": "tool_result",
+                        "tool_use_id": tc["id"],
+                    }
+                )
+            else:
+                # Add tool_result with document blocks INSIDE content (per Anthropic API spec).
+                # Each reference is copied and processed straight into the final content list. Formatting only
+                # rewrites source["data"], so copying the document and its source dict is enough (no deepcopy).
+                tool_result_content = [{"type": "text", "text": TOOL_RESULT_REFERENCES_TEXT}]
+                for ref in reference_list:
+                    # Process references - ALWAYS apply special formatting
+                    if "source" in ref and "data" in ref["source"]:
+                        # Use the robust document processing function
+                        doc = process_document_source_data({**ref, "source": {**ref["source"]}})
+                    else:
+                        doc = {**ref}
+                    tool_result_content.append(doc)
+
+                all_tool_result_content.append(
+                    {
+                        "type": "tool_result",
+                        "tool_use_id": tc["id"],
+                        "content": tool_result_content,
+                    }
+                )
 
         # Add ONE consolidated user message with all tool results
         if all_tool_result_content:
@@ -1210,7 +1549,51 @@ class AnsariClaude(Ansari):
                 "content": all_tool_result_content,
             }
             self.message_history.append(consolidated_message)
-            self._log_message(consolidated_message)
+            self._log_message(consolidated_message, trusted=True)
+
+    def _start_tool_call(self, tool_call):
+        """Start running a tool call, without waiting for its result.
+
+        The tool limit checks and usage tracking run right away on the calling thread, in the order the tool calls
+        arrive, so they don't depend on thread scheduling. Only the search itself (a blocking HTTP request) runs
+        in the shared tool executor. The outcome is collected later by _run_tool_calls.
+        """
+        if self._started_tool_calls is None:
+            self._started_tool_calls = {}
+        try:
+            outcome = self._prepare_tool_call(tool_call["name"], tool_call["input"], tool_call["id"])
+        except Exception as e:
+            outcome = e
+        else:
+            if len(outcome) == 2:
+                tool_instance, query = outcome
+                outcome = self._tool_executor.submit(self._run_tool, tool_call["name"], tool_instance, query)
+        self._started_tool_calls[tool_call["id"]] = outcome
+
+    def _run_tool_calls(self, tool_calls):
+        """Run the tool calls of one assistant turn, executing the searches concurrently.
+
+        Tool calls that were already started while the response streamed in (see _start_tool_call) are not
+        run again; their results are simply collected.
+
+        Returns:
+            One entry per tool call, in the original order: the process_tool_call result tuple,
+            or the exception raised while processing that call.
+        """
+        for tc in tool_calls:
+            if self._started_tool_calls is None or tc["id"] not in self._started_tool_calls:
+                self._start_tool_call(tc)
+
+        results = []
+        for tc in tool_calls:
+            outcome = self._started_tool_calls.pop(tc["id"])
+            if isinstance(outcome, Future):
+                try:
+                    outcome = outcome.result()
+                except Exception as e:
+                    outcome = e
+            results.append(outcome)
+        return results
 
     def _finish_response(self, assistant_text, tool_calls):
         """Handle the completion of a response, adding citations and finalizing the assistant message.
@@ -1233,83 +1616,20 @@ class AnsariClaude(Ansari):
         """
         citations_text = None
 
-        # Add citations list at the end if there were any citations
-        if self.citations:
-            citations_text = "\n\n**Citations**:\n"
-            logger.debug(f"Full Citations: {self.citations}")
-
-            # Process each citation
-            for i, citation in enumerate(self.citations, 1):
-                cited_text = getattr(citation, "cited_text", "")
-                title = getattr(citation, "document_title", "")
-                # Title is already trimmed by the search tools, but trim again in case of any direct citations
-                title = trim_citation_title(title)
-                citations_text += f"[{i}] {title}:\n"
-
-                # First, check if the citation text has already been processed
-                if any(lang in cited_text for lang in ["Arabic: ", "English: "]):
-                    citations_text += f"{cited_text}\n\n"
-                    continue
+        # Add citations list at the end if there were any citations during this turn
+        turn_citations = self.citations
+        if turn_citations:
+            # The citations text is built from parts and joined once at the end
+            citation_parts = ["\n\n**Citations**:\n"]
+            logger.debug("Full Citations: %s", turn_citations)
 
-                # Then, try to parse the citation as a multilingual JSON object
-                # This handles cases where Claude cites entire document content (which should be JSON)
-                try:
-                    # Attempt to parse as JSON
-                    multilingual_data = parse_multilingual_data(cited_text)
-                    logger.debug(f"Successfully parsed multilingual data: {multilingual_data}")
-
-                    # Extract Arabic and English text
-                    arabic_text = multilingual_data.get("ar", "")
-                    english_text = multilingual_data.get("en", "")
-
-                    # Add Arabic text if available
-                    if arabic_text:
-                        citations_text += f" Arabic: {arabic_text}\n\n"
-
-                    # Add English text if available, otherwise translate from Arabic
-                    if english_text:
-                        citations_text += f" English: {english_text}\n\n"
-                    elif arabic_text:
-                        english_translations = self._translate_with_event_loop_safety([arabic_text], "citation processing")
-                        english_translation = english_translations[0]
-                        citations_text += f" English: {english_translation}\n\n"
-
-                except json.JSONDecodeError:
-                    # Handle as plain text (Claude sometimes cites substrings which won't be valid JSON)
-                    logger.debug(f"Citation is not valid JSON - treating as plain text: {cited_text[:100]}...")
-
-                    # Try to detect the language and handle accordingly
-                    try:
-                        # Use the imported function
-                        lang = get_language_from_text(cited_text)
-                        if lang == "ar":
-                            # It's Arabic text
-                            arabic_text = cited_text
-                            citations_text += f" Arabic: {arabic_text}\n\n"
-
-                            # Translate to English
-                            try:
-                                english_translations = self._translate_with_event_loop_safety(
-                                    [arabic_text], "plain text citation"
-                                )
-                                english_translation = english_translations[0]
-                                citations_text += f" English: {english_translation}\n\n"
-                            except Exception as e:
-                                logger.error(f"Translation failed: {e}")
-                                citations_text += " English: [Translation unavailable]\n\n"
-                        else:
-                            # It's likely English or other language - just show as is
-                            citations_text += f" Text: {cited_text}\n\n"
-                    except Exception as e:
-                        # If language detection fails, default to treating as English
-                        logger.error(f"Language detection failed: {e}")
-                        citations_text += f" Text: {cited_text}\n\n"
+            # Citations are normally rendered in the background as they stream in (see _on_content_block_delta)
+            renders = self._citation_renders or {}
+            for i, citation in enumerate(turn_citations, self._turn_citations_start + 1):
+                render = renders.pop(i, None)
+                citation_parts.append(render.result() if render is not None else self._format_citation(i, citation))
 
-                except Exception as e:
-                    # Log other errors clearly
-                    logger.error(f"Citation processing error: {str(e)}")
-                    logger.error(f"Raw citation data: {cited_text}")
-                    citations_text += f" Text: {cited_text}\n\n"
+            citations_text = "".join(citation_parts)
 
         # Add the assistant's message to history
         # This is both the text and the tool use calls.
@@ -1360,17 +1680,14 @@ class AnsariClaude(Ansari):
             logger.error(f"assistant_message: {assistant_message}")
             logger.error(f"self.message_history type: {type(self.message_history)}")
 
-        # For logging, create a copy with tool_name for database storage
+        # For logging, pass tool_name alongside the message for database storage
         if tool_calls:
             logger.debug("Logging assistant message with tool_name")
-            log_message = assistant_message.copy()
-            log_message["tool_name"] = tool_calls[0]["name"]
-            # Log the message with tool_name for database
-            self._log_message(log_message)
+            self._log_message(assistant_message, tool_name=tool_calls[0]["name"], trusted=True)
         else:
             logger.debug("Logging regular assistant message")
             # Log the regular message
-            self._log_message(self.message_history[-1])
+            self._log_message(assistant_message, trusted=True)
 
         # Process any accumulated tool calls
         # Note: This is now handled by the helper method to avoid duplication
@@ -1387,6 +1704,80 @@ class AnsariClaude(Ansari):
 
         return citations_text
 
+    def _format_citation(self, i, citation):
+        """Render one entry of the citations list: its number, title and text (translated to English if needed)."""
+        parts = []
+        cited_text = getattr(citation, "cited_text", "")
+        title = getattr(citation, "document_title", "")
+        # Title is already trimmed by the search tools, but trim again in case of any direct citations
+        title = trim_citation_title(title)
+        parts.append(f"[{i}] {title}:\n")
+
+        # First, check if the citation text has already been processed
+        if any(lang in cited_text for lang in ["Arabic: ", "English: "]):
+            parts.append(f"{cited_text}\n\n")
+            return "".join(parts)
+
+        # Then, try to parse the citation as a multilingual JSON object
+        # This handles cases where Claude cites entire document content (which should be JSON)
+        try:
+            # Attempt to parse as JSON
+            multilingual_data = parse_multilingual_data(cited_text)
+            logger.debug("Successfully parsed multilingual data: %s", multilingual_data)
+
+            # Extract Arabic and English text
+            arabic_text = multilingual_data.get("ar", "")
+            english_text = multilingual_data.get("en", "")
+
+            # Add Arabic text if available
+            if arabic_text:
+                parts.append(f" Arabic: {arabic_text}\n\n")
+
+            # Add English text if available, otherwise translate from Arabic
+            if english_text:
+                parts.append(f" English: {english_text}\n\n")
+            elif arabic_text:
+                english_translations = self._translate_with_event_loop_safety([arabic_text], "citation processing")
+                english_translation = english_translations[0]
+                parts.append(f" English: {english_translation}\n\n")
+
+        except json.JSONDecodeError:
+            # Handle as plain text (Claude sometimes cites substrings which won't be valid JSON)
+            logger.debug("Citation is not valid JSON - treating as plain text: %.100s...", cited_text)
+
+            # Try to detect the language and handle accordingly
+            try:
+                # Use the imported function
+                lang = get_language_from_text(cited_text)
+                if lang == "ar":
+                    # It's Arabic text
+                    arabic_text = cited_text
+                    parts.append(f" Arabic: {arabic_text}\n\n")
+
+                    # Translate to English
+                    try:
+                        english_translations = self._translate_with_event_loop_safety([arabic_text], "plain text citation")
+                        english_translation = english_translations[0]
+                        parts.append(f" English: {english_translation}\n\n")
+                    except Exception as e:
+                        logger.error(f"Translation failed: {e}")
+                        parts.append(" English: [Translation unavailable]\n\n")
+                else:
+                    # It's likely English or other language - just show as is
+                    parts.append(f" Text: {cited_text}\n\n")
+            except Exception as e:
+                # If language detection fails, default to treating as English
+                logger.error(f"Language detection failed: {e}")
+                parts.append(f" Text: {cited_text}\n\n")
+
+        except Exception as e:
+            # Log other errors clearly
+            logger.error(f"Citation processing error: {str(e)}")
+            logger.error(f"Raw citation data: {cited_text}")
+            parts.append(f" Text: {cited_text}\n\n")
+
+        return "".join(parts)
+
     def _translate_with_event_loop_safety(self, arabic_texts: list[str], context: str = "citation") -> list[str]:
         """
         Safely translate multiple Arabic texts to English, handling both event loop contexts.
@@ -1429,6 +1820,8 @@ class AnsariClaude(Ansari):
         """
         Limit the total number of document blocks across all messages to prevent Claude from crashing.
         This creates a copy of the message history and modifies the copy, preserving the original data.
+        The copy is shallow: only messages that lose document blocks are copied, the rest are shared with
+        self.message_history and must not be mutated by the caller.
 
         Args:
             max_documents: Maximum number of documents to keep across all messages (default 100)
@@ -1436,20 +1829,26 @@ class AnsariClaude(Ansari):
         Returns:
             A copy of the message history with document count limited to max_documents
         """
-        # Create a deep copy of the message history to preserve original data
-        limited_history = copy.deepcopy(self.message_history)
+        # Copy the list only; messages are copied below if (and only if) documents are removed from them.
+        # Deep-copying every document of every message on each round was the dominant cost here.
+        limited_history = list(self.message_history)
 
-        # Count and collect all document blocks
+        # Collect the positions of all document blocks, oldest first: (msg_idx, block_idx, inner_idx), where
+        # inner_idx is None for a top-level block of the message, or the index of a document nested in the
+        # content of the tool_result at block_idx (which is where _process_tool_calls puts them)
         all_documents = []
-
-        # First, collect all document blocks with their positions in the message history
         for msg_idx, msg in enumerate(limited_history):
             if msg.get("role") == "user" and isinstance(msg.get("content"), list):
-                # Find document blocks in this message
                 for block_idx, block in enumerate(msg["content"]):
-                    if isinstance(block, dict) and block.get("type") == "document":
-                        # Store document with its position for later removal if needed
-                        all_documents.append({"document": block, "position": (msg_idx, block_idx)})
+                    if not isinstance(block, dict):
+                        continue
+                    block_type = block.get("type")
+                    if block_type == "document":
+                        all_documents.append((msg_idx, block_idx, None))
+                    elif block_type == "tool_result" and isinstance(block.get("content"), list):
+                        for inner_idx, inner in enumerate(block["content"]):
+                            if isinstance(inner, dict) and inner.get("type") == "document":
+                                all_documents.append((msg_idx, block_idx, inner_idx))
 
         document_count = len(all_documents)
         logger.debug(f"Found {document_count} document blocks in message history")
@@ -1458,110 +1857,150 @@ class AnsariClaude(Ansari):
         if document_count > max_documents:
             logger.warning(f"Limiting documents from {document_count} to {max_documents}")
 
-            # Calculate how many documents to remove
-            documents_to_remove = document_count - max_documents
-
-            # Sort by position - earliest messages first (these will be removed)
-            all_documents.sort(key=lambda x: x["position"][0])
-
-            # Get the positions of documents to remove
-            positions_to_remove = [doc["position"] for doc in all_documents[:documents_to_remove]]
-
-            # Now remove documents from the copy of the message history
-            # We need to process messages in reverse order to avoid index shifting
+            # Group the positions of the documents to remove by message, then by block
             positions_by_message = {}
-            for msg_idx, block_idx in positions_to_remove:
-                if msg_idx not in positions_by_message:
-                    positions_by_message[msg_idx] = []
-                positions_by_message[msg_idx].append(block_idx)
-
-            # For each message, remove blocks in reverse order
-            for msg_idx in sorted(positions_by_message.keys()):
-                block_indices = sorted(positions_by_message[msg_idx], reverse=True)
-
-                # Get the message content
-                if isinstance(limited_history[msg_idx].get("content"), list):
-                    for block_idx in block_indices:
-                        # Remove this document block
-                        logger.debug(f"Removing document block at position {msg_idx},{block_idx}")
-                        if block_idx < len(limited_history[msg_idx]["content"]):
-                            limited_history[msg_idx]["content"].pop(block_idx)
+            for msg_idx, block_idx, inner_idx in all_documents[: document_count - max_documents]:
+                positions_by_message.setdefault(msg_idx, {}).setdefault(block_idx, set()).add(inner_idx)
+
+            for msg_idx, blocks in positions_by_message.items():
+                logger.debug(f"Removing document blocks from message {msg_idx}")
+                # Build copies of the message, its content list and any tool_result that loses documents
+                msg = limited_history[msg_idx]
+                content = []
+                for block_idx, block in enumerate(msg["content"]):
+                    inner_indices = blocks.get(block_idx)
+                    if inner_indices is None:
+                        content.append(block)
+                    elif None not in inner_indices:
+                        inner_content = [x for i, x in enumerate(block["content"]) if i not in inner_indices]
+                        content.append({**block, "content": inner_content})
+                    # else: the block itself is a removed document
+                limited_history[msg_idx] = {**msg, "content": content}
 
         return limited_history
 
-    def process_message_history(self, use_tool=True):
+    def _add_cache_breakpoint(self, messages, index):
+        """Put an ephemeral cache_control marker on the last content block of messages[index].
+
+        The message (and the block) are replaced by modified copies, since the messages returned by
+        limit_documents_in_message_history are shared with self.message_history.
         """
-        This is the main loop that processes the message history.
-        It yields from the process_one_round method until the last message is an assistant message.
-        The assumption coming in to this is that it ends with a user message.
+        message = messages[index] = dict(messages[index])
+        content = message.get("content")
+        if isinstance(content, list) and len(content) > 0:
+            # Only add to the last block (the API rejects cache_control on empty text blocks)
+            last_block = content[-1]
+            if isinstance(last_block, dict) and not (last_block.get("type") == "text" and not last_block.get("text")):
+                message["content"] = [*content[:-1], {**last_block, "cache_control": {"type": "ephemeral"}}]
+            logger.debug(f"Added ephemeral cache control to last content block of message with role: {message.get('role')}")
+        elif isinstance(content, str) and content:
+            # If content is a string, convert to list format with cache control
+            message["content"] = [{"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}]
+            logger.debug(f"Converted string content to list format with cache control for role: {message.get('role')}")
+
+    @staticmethod
+    def _tool_use_name(message):
+        """Return the name of the first tool used in an assistant message (what the message logger records), or None."""
+        if message["role"] == "assistant" and type(message["content"]) is list:
+            for block in message["content"]:
+                if type(block) is dict and block.get("type") == "tool_use":
+                    return block["name"]
+        return None
+
+    def mark_history_dirty(self):
+        """Force the next process_message_history call to re-normalize and re-validate the whole message history.
+
+        Normalization and validation only scan messages appended since the previous call. Callers that edit
+        earlier messages of self.message_history in place must call this so those edits are checked again.
         """
-        logger.debug("Starting process_message_history")
-        logger.debug(f"Initial message history length: {len(self.message_history)}")
+        self._normalized_upto = 0
+        self._normalized_last = None
+        self._validated_upto = 0
+        self._validated_last = None
 
-        if len(self.message_history) > 0:
-            logger.debug(f"Last message role: {self.message_history[-1]['role']}")
-            last_role = self.message_history[-1]["role"]
-            if last_role == "assistant":
-                logger.debug("Message history already ends with assistant message, no processing needed")
+    def _history_fingerprint(self):
+        """Return a cheap fingerprint of the message history for loop detection.
 
-        count = 0
-        # Store the previous state of the entire message history for simple comparison
-        prev_history_json = json.dumps(self.message_history)
+        A round always appends to or rewrites the tail of the history, so its length, last message and
+        the size of that message's content are enough to tell whether anything changed. The last message
+        is held by reference (not id()) so a freed dict can't be mistaken for it.
+        """
+        if not self.message_history:
+            return (0, None, 0)
+        last = self.message_history[-1]
+        content = last.get("content")
+        return (len(self.message_history), last, len(content) if content is not None else 0)
+
+    def _normalize_message_history(self):
+        """Bring messages added since the previous call into the format the API expects.
+
+        Assistant content is converted to blocks, and tool_result blocks without a matching tool_use are dropped.
+        """
+        # Only messages appended since the previous call need to be scanned and normalized. If the history was
+        # replaced or edited before the watermark (e.g. by _fix_tool_use_result_relationship), start over.
+        start = self._normalized_upto
+        if not (0 < start <= len(self.message_history) and self.message_history[start - 1] is self._normalized_last):
+            start = 0
+            self._tool_use_ids = set()
 
         # Track tool_use_ids to ensure tool_result blocks have matching tool_use blocks
-        tool_use_ids = set()
+        tool_use_ids = self._tool_use_ids
+
+        # Messages and blocks are plain dicts/lists/strs (decoded JSON/BSON or built here), so exact type checks
+        # are enough in these per-block loops and cheaper than isinstance()
 
         # First pass: collect all tool_use IDs
-        for msg in self.message_history:
-            if msg.get("role") == "assistant" and isinstance(msg.get("content"), list):
-                for block in msg["content"]:
-                    if isinstance(block, dict) and block.get("type") == "tool_use" and "id" in block:
+        new_messages = self.message_history[start:]
+        for msg in new_messages:
+            content = msg.get("content")
+            if type(content) is list and msg.get("role") == "assistant":
+                for block in content:
+                    if type(block) is dict and block.get("type") == "tool_use" and "id" in block:
                         tool_use_ids.add(block["id"])
-                        logger.debug(f"Found tool_use block with ID: {block['id']}")
+                        logger.debug("Found tool_use block with ID: %s", block["id"])
 
-        logger.debug(f"Found tool_use_ids: {tool_use_ids}")
+        logger.debug("Found tool_use_ids: %s", tool_use_ids)
 
-        # Sanitize tool_result.content: fix existing DB records where tools returned
-        # ["No results found."] (bare string) instead of [].
-        for msg in self.message_history:
-            if msg.get("role") == "user" and isinstance(msg.get("content"), list):
-                for block in msg["content"]:
-                    if isinstance(block, dict) and block.get("type") == "tool_result":
-                        tool_content = block.get("content", [])
-                        if isinstance(tool_content, list) and "No results found." in tool_content:
-                            logger.warning(
-                                f"Removing tool_result.content containing 'No results found.' for {block.get('tool_use_id')}"
-                            )
-                            del block["content"]
-
-        # Second pass: ensure all messages have proper format for the API
-        for i in range(len(self.message_history)):
-            msg = self.message_history[i]
+        # Second pass: ensure all messages have proper format for the API. A restored conversation
+        # (replace_message_history) runs through every message here, so all per-message fixes share this one pass.
+        for msg in new_messages:
+            role = msg.get("role")
+            content = msg.get("content")
 
             # All assistant messages must use the block format
-            if msg.get("role") == "assistant":
-                if isinstance(msg.get("content"), str):
+            if role == "assistant":
+                if type(content) is str:
                     # Convert string to text block
-                    self.message_history[i]["content"] = [{"type": "text", "text": msg["content"]}]
-                elif isinstance(msg.get("content"), list):
+                    msg["content"] = [{"type": "text", "text": content}]
+                elif type(content) is list:
                     # Check if content is already in correct format with blocks having "type" field
-                    has_valid_blocks = all(isinstance(item, dict) and "type" in item for item in msg["content"])
+                    has_valid_blocks = all(type(item) is dict and "type" in item for item in content)
                     if not has_valid_blocks:
                         # If not blocks, convert the whole list to a text block
-                        logger.warning(f"Fixing assistant message with improper content format: {msg['content']}")
-                        self.message_history[i]["content"] = [{"type": "text", "text": str(msg["content"])}]
+                        logger.warning(f"Fixing assistant message with improper content format: {content}")
+                        msg["content"] = [{"type": "text", "text": str(content)}]
                 else:
                     # Convert any other content type to text block
-                    self.message_history[i]["content"] = [{"type": "text", "text": str(msg["content"])}]
+                    msg["content"] = [{"type": "text", "text": str(content)}]
 
             # User messages with tool_result need to have matching tool_use blocks
-            elif msg.get("role") == "user" and isinstance(msg.get("content"), list):
-                fixed_content = []
-                has_invalid_tool_result = False
+            elif role == "user" and type(content) is list:
+                # Only copy blocks into a new list once an invalid tool_result has to be dropped
+                fixed_content = None
 
-                for block in msg["content"]:
+                for j, block in enumerate(content):
                     # Check if this is a tool_result block
-                    is_tool_result = isinstance(block, dict) and (block.get("type") == "tool_result" or "tool_use_id" in block)
+                    is_tool_result = type(block) is dict and (block.get("type") == "tool_result" or "tool_use_id" in block)
+
+                    # Sanitize tool_result.content: fix existing DB records where tools returned
+                    # ["No results found."] (bare string) instead of [].
+                    if is_tool_result and block.get("type") == "tool_result":
+                        tool_content = block.get("content", [])
+                        if type(tool_content) is list and "No results found." in tool_content:
+                            logger.warning(
+                                f"Removing tool_result.content containing 'No results found.' for {block.get('tool_use_id')}"
+                            )
+                            del block["content"]
 
                     if is_tool_result:
                         # Ensure it has type field
@@ -1571,28 +2010,57 @@ class AnsariClaude(Ansari):
 
                         # Check if the tool_use_id exists in our collected IDs
                         if "tool_use_id" in block and block["tool_use_id"] not in tool_use_ids:
-                            has_invalid_tool_result = True
+                            if fixed_content is None:
+                                fixed_content = content[:j]
                             logger.warning(f"Found tool_result with ID {block['tool_use_id']} but no matching tool_use block")
                             # Skip this block - it has no matching tool_use
                             continue
 
                     # Keep this block
-                    fixed_content.append(block)
+                    if fixed_content is not None:
+                        fixed_content.append(block)
 
                 # If we had to remove invalid tool_result blocks and now have an empty list,
                 # replace with a simple text message
-                if has_invalid_tool_result:
+                if fixed_content is not None:
                     if not fixed_content:
-                        self.message_history[i]["content"] = "Tool result (missing matching tool_use)"
+                        msg["content"] = "Tool result (missing matching tool_use)"
                     else:
-                        self.message_history[i]["content"] = fixed_content
+                        msg["content"] = fixed_content
+
+        self._normalized_upto = len(self.message_history)
+        self._normalized_last = self.message_history[-1] if self.message_history else None
+
+    def process_message_history(self, use_tool=True):
+        """
+        This is the main loop that processes the message history.
+        It yields from the process_one_round method until the last message is an assistant message.
+        The assumption coming in to this is that it ends with a user message.
+        """
+        logger.debug("Starting process_message_history")
+        logger.debug(f"Initial message history length: {len(self.message_history)}")
+
+        if len(self.message_history) > 0:
+            logger.debug(f"Last message role: {self.message_history[-1]['role']}")
+            last_role = self.message_history[-1]["role"]
+            if last_role == "assistant":
+                logger.debug("Message history already ends with assistant message, no processing needed")
+                # Nothing will be sent to the API, so skip the normalization passes and loop setup as well
+                return
+
+        count = 0
+        # Store a fingerprint of the message history to detect rounds that don't change it
+        prev_fingerprint = self._history_fingerprint()
+
+        self._normalize_message_history()
 
         # Check if the last message is a user message and needs to be logged.
         # This check avoids double-logging the user message which is already logged in the parent Ansari.process_input method
         if len(self.message_history) > 0 and self.message_history[-1]["role"] == "user":
+            # Messages logged through _log_message are recognized by identity, which is O(1)
+            should_log = self.message_history[-1] is not self._last_logged_message
             # Check if this message was logged by parent class by inspecting if it exists in the logger
-            should_log = True
-            if self.message_logger and hasattr(self.message_logger, "messages"):
+            if should_log and self.message_logger and hasattr(self.message_logger, "messages"):
                 # If the last logged message in the logger matches the last message in history, don't log it again
                 if (
                     len(self.message_logger.messages) > 0
@@ -1605,6 +2073,39 @@ class AnsariClaude(Ansari):
                 # Log the message if needed
                 self._log_message(self.message_history[-1])
 
+        # The citations list at the end of this turn's answer only covers citations made during the turn,
+        # so earlier turns' citations (and any renders a failed turn left behind) are dropped
+        self._turn_citations_start += len(self.citations)
+        self.citations = []
+        self._citation_renders = {}
+
+        # A conversation that was already answered is replayed from the response cache without calling Claude
+        response_cache = get_response_cache()
+        cache_key = None
+        if response_cache is not None and self.message_history and self.message_history[-1]["role"] == "user":
+            # A routing model may write the answer too (see _select_model), so it is part of the key
+            model = self.settings.ANTHROPIC_MODEL
+            if routing_model := self.settings.ANTHROPIC_ROUTING_MODEL:
+                model = f"{model}+{routing_model}"
+            cache_key = ResponseCache.make_key(model, self._get_system_prompt(), self.tools, self.message_history)
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                logger.debug(f"Replaying cached response ({len(cached['messages'])} messages)")
+                with self._batched_logging():
+                    for message in cached["messages"]:
+                        self.message_history.append(message)
+                        # The messages were validated when the turn was first answered
+                        self._log_message(message, tool_name=self._tool_use_name(message), trusted=True)
+                self._wait_for_log_writes()
+                # Later turns number their citations after the ones in the replayed answer
+                self._turn_citations_start += cached.get("citations", 0)
+                if cached["text"]:
+                    yield cached["text"]
+                return
+        turn_start = len(self.message_history)
+        turn_text = []  # Text yielded during this turn, only kept when it is going to be cached
+        turn_failed = False
+
         logger.debug(f"Starting message processing loop with history length: {len(self.message_history)}")
         if len(self.message_history) > 0:
             logger.debug(f"Last message role before loop: {self.message_history[-1]['role']}")
@@ -1615,10 +2116,12 @@ class AnsariClaude(Ansari):
         max_iterations = 10  # Reasonable upper limit based on expected conversation flow
         while len(self.message_history) > 0 and self.message_history[-1]["role"] != "assistant" and count < max_iterations:
             logger.debug(f"Processing message iteration: {count}")
-            logger.debug("Current message history:\n" + "-" * 60)
-            for i, msg in enumerate(self.message_history):
-                logger.debug(f"Message {i}:\n{json.dumps(msg, indent=2)}")
-            logger.debug("-" * 60)
+            # Pretty-printing every message is expensive, so only do it when debug output is enabled
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Current message history:\n" + "-" * 60)
+                for i, msg in enumerate(self.message_history):
+                    logger.debug("Message %d:\n%s", i, json.dumps(msg, indent=2))
+                logger.debug("-" * 60)
 
             # This is pretty complicated so leaving a comment.
             # We want to yield from so that we can send the sequence through the input
@@ -1627,30 +2130,33 @@ class AnsariClaude(Ansari):
             logger.debug("Calling process_one_round()")
 
             try:
-                yield from self.process_one_round()
+                # Messages logged during the round are written to the database together once it ends
+                with self._batched_logging():
+                    for chunk in self.process_one_round():
+                        if cache_key is not None:
+                            turn_text.append(chunk)
+                        yield chunk
                 logger.debug(f"After process_one_round(), message history length: {len(self.message_history)}")
 
-                # Simple check - compare entire message history with previous state
-                current_history_json = json.dumps(self.message_history)
+                # Simple check - compare the history fingerprint with the previous state
+                current_fingerprint = self._history_fingerprint()
 
-                # Check if message_history is identical to previous iteration
-                if current_history_json == prev_history_json:
+                # Check if message_history is unchanged since the previous iteration
+                if current_fingerprint == prev_fingerprint:
                     logger.warning("Message history hasn't changed since last iteration - loop detected!")
 
-                    # Add a text-only message indicating the loop
+                    # Add a text-only message indicating the loop (a fresh dict, since history messages get mutated)
                     self.message_history.append(
-                        {
-                            "role": "assistant",
-                            "content": [{"type": "text", "text": "I got stuck in a loop. Please rephrase your question."}],
-                        }
+                        {"role": "assistant", "content": [{"type": "text", "text": LOOP_STUCK_MESSAGE}]}
                     )
                     # Log this message
                     self._log_message(self.message_history[-1])
+                    turn_failed = True
                     # Break out of the loop
                     break
 
                 # Update previous state for next iteration comparison
-                prev_history_json = current_history_json
+                prev_fingerprint = current_fingerprint
 
                 if len(self.message_history) > 0:
                     logger.debug(f"Last message role after process_one_round: {self.message_history[-1]['role']}")
@@ -1676,11 +2182,15 @@ class AnsariClaude(Ansari):
                 }
                 self.message_history.append(error_message)
                 self._log_message(error_message)
+                turn_failed = True
                 # Don't raise - log and continue to avoid breaking the loop
 
             count += 1
             logger.debug(f"Completed iteration {count} of message processing")
 
+        # The turn is only over once its messages are stored
+        self._wait_for_log_writes()
+
         # Log the final state after processing completes
         logger.debug(f"Finished process_message_history after {count} iterations")
         logger.debug(f"Final message history length: {len(self.message_history)}")
@@ -1689,9 +2199,133 @@ class AnsariClaude(Ansari):
         if count >= max_iterations:
             logger.warning(f"Hit max iterations limit ({max_iterations}). Check for processing issues.")
 
+        # Only complete, successful turns are cached
+        if cache_key is not None and not turn_failed and self.message_history[-1]["role"] == "assistant":
+            response_cache.set(cache_key, "".join(turn_text), self.message_history[turn_start:], len(self.citations))
+
         if len(self.message_history) > 0:
             logger.debug(f"Final message role: {self.message_history[-1]['role']}")
             if self.message_history[-1]["role"] != "assistant":
                 logger.warning("Processing completed but final message is not from assistant!")
         else:
             logger.warning("Processing completed but message history is empty!")
+
+    def _apply_batch_message(self, message):
+        """Add a complete (non-streamed) response from the Message Batches API to the history, like a streamed round.
+
+        Citation markers are placed after the text they belong to, and tool calls are run before returning.
+        """
+        text_parts = []
+        tool_calls = []
+        for block in message.content:
+            if block.type == "text":
+                text_parts.append(block.text)
+                for citation in getattr(block, "citations", None) or ():
+                    self.citations.append(citation)
+                    text_parts.append(f" [{self._turn_citations_start + len(self.citations)}] ")
+            elif block.type == "tool_use":
+                tool_calls.append({"type": "tool_use", "id": block.id, "name": block.name, "input": block.input})
+
+        if message.stop_reason == "tool_use" and tool_calls:
+            self._add_tool_use_message(tool_calls)
+        else:
+            self._finish_response("".join(text_parts), tool_calls)
+
+    @classmethod
+    def process_message_histories_in_batch(
+        cls, settings: Settings, message_histories: list[list[dict]], poll_interval: float = BATCH_POLL_INTERVAL
+    ) -> list[list[dict]]:
+        """Answer many conversations through Anthropic's Message Batches API instead of one live request each.
+
+        Meant for offline work such as evaluations: batched requests cost half as much, but a batch can take
+        minutes (at worst hours) to finish. Each round of every unanswered conversation goes into one batch, and
+        tool calls are run locally between rounds, as in process_message_history.
+
+        Returns:
+            The message histories, in the same order, each ending with Ansari's answer
+        """
+        agents = []
+        for message_history in message_histories:
+            agent = cls(settings)
+            agent._load_message_history(message_history)
+            agents.append(agent)
+        if not agents:
+            return []
+        batches = agents[0].client.messages.batches
+
+        # A batch can take hours; a transient API error while submitting or polling must not lose every result,
+        # so these calls are retried like _call_claude_api's
+        retrying = Retrying(
+            stop=stop_after_attempt(settings.MAX_FAILURES),
+            wait=_api_retry_wait,
+            retry=retry_if_exception(_is_retryable_api_error),
+            before_sleep=lambda retry_state: logger.warning(
+                f"Message batch API call failed ({retry_state.outcome.exception()}), "
+                f"retrying in {retry_state.next_action.sleep:.2f}s"
+            ),
+            sleep=time.sleep,
+            reraise=True,
+        )
+
+        def end_with_error(agent):
+            error_message = {
+                "role": "assistant",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": "I encountered a problem processing your request. "
+                        + "Please try again or rephrase your question.",
+                    }
+                ],
+            }
+            agent.message_history.append(error_message)
+            agent._log_message(error_message)
+
+        for round_number in range(1, BATCH_MAX_ROUNDS + 1):
+            pending = {
+                str(i): agent
+                for i, agent in enumerate(agents)
+                if agent.message_history and agent.message_history[-1]["role"] != "assistant"
+            }
+            if not pending:
+                break
+
+            requests = []
+            for custom_id, agent in pending.items():
+                agent._normalize_message_history()
+                params = agent._build_request_params()
+                params.pop("stream")
+                requests.append({"custom_id": custom_id, "params": params})
+
+            batch = retrying(batches.create, requests=requests)
+            logger.info(f"Submitted message batch {batch.id} (round {round_number}) with {len(requests)} requests")
+            while batch.processing_status != "ended":
+                time.sleep(poll_interval)
+                batch = retrying(batches.retrieve, batch.id)
+
+            # The results are streamed; read them all inside the retry so a dropped connection can be retried
+            for response in retrying(lambda: list(batches.results(batch.id))):
+                agent = pending.get(response.custom_id)
+                if agent is None:
+                    continue
+                if response.result.type != "succeeded":
+                    logger.error(f"Batch request {response.custom_id} did not succeed: {response.result.type}")
+                    continue
+                try:
+                    agent._apply_batch_message(response.result.message)
+                except Exception as e:
+                    logger.error(f"Error applying batch result {response.custom_id}: {str(e)}")
+                    continue
+                del pending[response.custom_id]
+
+            # Requests that failed (or never came back) end their conversation with the usual error message
+            for agent in pending.values():
+                end_with_error(agent)
+
+        # So do conversations still waiting on tool results after BATCH_MAX_ROUNDS rounds
+        for agent in agents:
+            if agent.message_history and agent.message_history[-1]["role"] != "assistant":
+                logger.warning(f"Conversation not answered after {BATCH_MAX_ROUNDS} batch rounds")
+                end_with_error(agent)
+
+        return [agent.message_history for agent in agents]
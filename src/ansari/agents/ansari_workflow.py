@@ -9,8 +9,6 @@
 import logging
 import sys
 
-import litellm
-
 from ansari.ansari_db import MessageLogger
 from ansari.ansari_logger import get_logger
 from ansari.tools.search_hadith import SearchHadith
@@ -96,6 +94,12 @@ class AnsariWorkflow:
     def set_message_logger(self, message_logger: MessageLogger):
         self.message_logger = message_logger
 
+    def _completion(self, **kwargs):
+        # litellm takes seconds to import, so it is only loaded once a workflow step actually needs the LLM
+        import litellm
+
+        return litellm.completion(**kwargs)
+
     def _execute_search_step(self, step_params, prev_outputs):
         tool = self.tool_name_to_instance[step_params["tool_name"]]
         if "query" in step_params:
@@ -122,7 +126,7 @@ class AnsariWorkflow:
         - Relevant words/phrases that appear in or closely match content in '{step_params["target_corpus"]}'
         - Usable for both keyword and semantic search
         - Given as a simple list without explanation or complete sentences"""
-        model_response = litellm.completion(
+        model_response = self._completion(
             model=self.model,
             messages=[
                 {"role": "system", "content": self.sys_msg},
@@ -154,7 +158,7 @@ class AnsariWorkflow:
             
             Reminder: the key question is: '{step_params["input"]}'. 
             """
-        model_response = litellm.completion(
+        model_response = self._completion(
             model=self.model,
             messages=[
                 {"role": "system", "content": self.sys_msg},
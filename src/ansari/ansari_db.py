@@ -44,8 +44,13 @@ class MessageLogger:
     def log(
         self,
         message,
+        tool_name: Optional[str] = None,
     ) -> None:
-        self.db.append_message(self.source, self.thread_id, message)
+        self.db.append_message(self.source, self.thread_id, message, tool_name=tool_name)
+
+    def log_many(self, messages: list[tuple[dict, Optional[str]]]) -> None:
+        """Log several messages at once; each entry is a (message, tool_name) pair."""
+        self.db.append_messages(self.source, self.thread_id, messages)
 
 
 class AnsariDB:
@@ -405,6 +410,7 @@ class AnsariDB:
         source: SourceType,
         thread_id: ObjectId,
         message,
+        tool_name: Optional[str] = None,
     ) -> None:
         """Append a message to the given thread.
 
@@ -416,18 +422,22 @@ class AnsariDB:
             user_id: The user ID (ObjectId)
             thread_id: The thread ID (ObjectId)
             message: The message content
+            tool_name: Optional name of the tool used in this message, stored alongside it
         """
         try:
             new_message = {**message}
+            if tool_name:
+                new_message["tool_name"] = tool_name
             new_message["id"] = str(ObjectId())
             new_message["source"] = source.value
-            new_message["created_at"] = datetime.now(timezone.utc)
+            now = datetime.now(timezone.utc)
+            new_message["created_at"] = now
 
             self.get_collection("threads").update_one(
                 {"_id": ObjectId(thread_id)},
                 {
                     "$push": {"messages": new_message},
-                    "$set": {"updated_at": datetime.now(timezone.utc)},
+                    "$set": {"updated_at": now},
                 },
             )
 
@@ -435,6 +445,48 @@ class AnsariDB:
             logger.warning(f"Error appending message to database: {e}")
             raise
 
+    def append_messages(
+        self,
+        source: SourceType,
+        thread_id: ObjectId,
+        messages: list[tuple[dict, Optional[str]]],
+    ) -> None:
+        """Append several messages to the given thread with a single database update.
+
+        The messages are stored exactly as append_message would store them, in the given order.
+
+        Args:
+            source: The source of the messages
+            thread_id: The thread ID (ObjectId)
+            messages: (message, tool_name) pairs, where tool_name may be None
+        """
+        if not messages:
+            return
+
+        try:
+            now = datetime.now(timezone.utc)
+            new_messages = []
+            for message, tool_name in messages:
+                new_message = {**message}
+                if tool_name:
+                    new_message["tool_name"] = tool_name
+                new_message["id"] = str(ObjectId())
+                new_message["source"] = source.value
+                new_message["created_at"] = now
+                new_messages.append(new_message)
+
+            self.get_collection("threads").update_one(
+                {"_id": ObjectId(thread_id)},
+                {
+                    "$push": {"messages": {"$each": new_messages}},
+                    "$set": {"updated_at": now},
+                },
+            )
+
+        except Exception as e:
+            logger.warning(f"Error appending messages to database: {e}")
+            raise
+
     def get_thread(self, thread_id, user_id):
         """Get all messages in a thread.
         This version is designed to be used by humans. In particular,
@@ -519,7 +571,8 @@ class AnsariDB:
         try:
             # First we retrieve the thread.
             thread = self.get_thread(thread_id, user_id)
-            logger.info(f"Thread is {json.dumps(thread)}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Thread is {json.dumps(thread)}")
             result = self.get_collection("share").insert_one({"content": thread})
             logger.info(f"Result is {result}")
             return str(result.inserted_id)
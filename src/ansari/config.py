@@ -185,6 +185,8 @@ class Settings(BaseSettings):
     ZROK_SHARE_TOKEN: SecretStr = Field(default="")
     template_dir: DirectoryPath = Field(default=get_resource_path("templates"))
     diskcache_dir: str = Field(default="diskcache_dir")
+    # Seconds a finished Claude turn is kept for replay when the same conversation comes in again (0 disables it)
+    RESPONSE_CACHE_TTL: int = Field(default=0)
 
     MODEL: str = Field(default="gpt-4o")
     MAX_TOOL_TRIES: int = Field(default=3)
@@ -193,6 +195,13 @@ class Settings(BaseSettings):
     PROMPT_PATH: str = Field(default=str(get_resource_path("prompts")))
     AGENT: str = Field(default="AnsariClaude")
     ANTHROPIC_MODEL: str = Field(default="claude-sonnet-4-5")
+    # Faster model (e.g. "claude-haiku-4-5") for the round that answers a new user question, which is mostly
+    # about choosing which tools to call. Later rounds (after tool results) use ANTHROPIC_MODEL. Note that the
+    # routing model writes the whole answer when no tools are called, and that the prompt cache is not shared
+    # between the two models. Empty disables it.
+    ANTHROPIC_ROUTING_MODEL: str = Field(default="")
+    # Searches each Claude agent can run at once; every agent has its own pool, so this doesn't limit the server
+    TOOL_EXECUTOR_MAX_WORKERS: int = Field(default=16)
     LOGGING_LEVEL: str = Field(default="INFO")
     DEV_MODE: bool = Field(default=False)
 
@@ -0,0 +1,74 @@
+# This file provides a cache of finished AnsariClaude turns, so that a conversation that was already answered
+# (same model, system prompt, tools and message history) is replayed without calling Claude. Single-question
+# conversations match on the normalized question, so differences in case, spacing or trailing punctuation still hit.
+
+import hashlib
+import json
+import os
+from typing import Optional
+
+from diskcache import FanoutCache
+
+from ansari.ansari_logger import get_logger
+from ansari.config import get_settings
+
+logger = get_logger(__name__)
+
+_response_cache = None
+
+
+class ResponseCache:
+    """Stores the text yielded for a turn, the messages it appended to the history and its number of citations,
+    keyed by the request.
+    """
+
+    def __init__(self, directory: str, ttl: int):
+        self._cache = FanoutCache(directory, shards=4, timeout=1)
+        self.ttl = ttl
+
+    @staticmethod
+    def normalize_question(text: str) -> str:
+        """Reduce a question to the form it is cached under: case, spacing and trailing punctuation don't matter."""
+        return " ".join(text.casefold().split()).rstrip("?!.؟ ")
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, tools: list, message_history: list) -> str:
+        """Hash everything that determines Claude's response into a cache key.
+
+        A conversation that is just one question is keyed on the normalized question, so that the same question
+        typed slightly differently ("What is zakat?" / "what is zakat") is answered from the cache too.
+        """
+        if len(message_history) == 1 and isinstance(question := message_history[0].get("content"), str):
+            message_history = [{**message_history[0], "content": ResponseCache.normalize_question(question)}]
+        payload = json.dumps(
+            {"model": model, "system": system_prompt, "tools": tools, "messages": message_history},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        """Return the cached turn ({"text": ..., "messages": [...], "citations": ...}) for `key`, or None."""
+        try:
+            return self._cache.get(key)
+        except Exception as e:
+            logger.warning(f"Response cache lookup failed: {e}")
+            return None
+
+    def set(self, key: str, text: str, messages: list[dict], citations: int = 0) -> None:
+        """Cache the text yielded for a turn, the messages it added to the history and how many citations it made."""
+        try:
+            self._cache.set(key, {"text": text, "messages": messages, "citations": citations}, expire=self.ttl)
+        except Exception as e:
+            logger.warning(f"Response cache update failed: {e}")
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Return the process-wide response cache, or None if RESPONSE_CACHE_TTL disables it."""
+    global _response_cache
+    settings = get_settings()
+    if settings.RESPONSE_CACHE_TTL <= 0:
+        return None
+    if _response_cache is None:
+        _response_cache = ResponseCache(os.path.join(settings.diskcache_dir, "responses"), settings.RESPONSE_CACHE_TTL)
+    return _response_cache
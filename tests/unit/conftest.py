@@ -0,0 +1,37 @@
+import sys
+import os
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+# Add the src directory to the path so we can import the modules
+src_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.insert(0, src_path)
+
+from ansari.agents.ansari_claude import AnsariClaude
+from ansari.config import get_settings
+
+
+@pytest.fixture
+def make_claude():
+    """Build AnsariClaude agents through the real __init__, with a mocked Anthropic client and no tools.
+
+    Each agent gets its own client mock (claude.client) and its own copy of the settings, so a test can change
+    either (and set claude.tool_name_to_instance) without affecting other agents. Keyword arguments override
+    settings fields.
+    """
+
+    def make(message_history=None, message_logger=None, **settings_overrides):
+        settings = get_settings().model_copy(
+            update={"ANTHROPIC_MODEL": "claude-3-opus-20240229", "ANTHROPIC_ROUTING_MODEL": "", "MAX_FAILURES": 3}
+            | settings_overrides
+        )
+        with (
+            patch("anthropic.Anthropic", side_effect=lambda **kwargs: MagicMock()),
+            patch.object(AnsariClaude, "_initialize_tools", return_value={}),
+        ):
+            claude = AnsariClaude(settings, message_logger=message_logger)
+        claude.message_history = list(message_history or [])
+        return claude
+
+    return make
@@ -0,0 +1,147 @@
+import sys
+import os
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import anthropic
+import httpx
+
+# Add the src directory to the path so we can import the modules
+src_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.insert(0, src_path)
+
+from ansari.agents.ansari_claude import AnsariClaude
+from ansari.config import get_settings
+
+
+def _succeeded(custom_id, content, stop_reason):
+    message = SimpleNamespace(content=content, stop_reason=stop_reason)
+    return SimpleNamespace(custom_id=custom_id, result=SimpleNamespace(type="succeeded", message=message))
+
+
+def _text(text):
+    return SimpleNamespace(type="text", text=text, citations=None)
+
+
+def test_conversations_are_answered_round_by_round_in_batches():
+    tool = MagicMock()
+    tool.get_tool_description.return_value = {
+        "type": "function",
+        "function": {"name": "search_quran", "description": "Search the Quran", "parameters": {"type": "object"}},
+    }
+    tool.run.return_value = ["result"]
+    tool.format_as_tool_result.return_value = "result"
+    tool.format_as_ref_list.return_value = [
+        {"type": "document", "source": {"type": "text", "media_type": "text/plain", "data": "Verse"}}
+    ]
+    tool_use = SimpleNamespace(type="tool_use", id="tool_1", name="search_quran", input={"query": "mercy"})
+
+    with (
+        patch("anthropic.Anthropic") as mock_anthropic,
+        patch.object(AnsariClaude, "_initialize_tools", return_value={"search_quran": tool}),
+        patch.object(AnsariClaude, "_get_system_prompt", return_value="System prompt"),
+        patch("ansari.agents.ansari_claude.time.sleep") as mock_sleep,
+    ):
+        batches = mock_anthropic.return_value.messages.batches
+        batches.create.side_effect = [
+            SimpleNamespace(id="batch_1", processing_status="in_progress"),
+            SimpleNamespace(id="batch_2", processing_status="in_progress"),
+        ]
+        batches.retrieve.side_effect = lambda batch_id: SimpleNamespace(id=batch_id, processing_status="ended")
+        batches.results.side_effect = [
+            # First round: one conversation needs a search, the other is answered directly
+            [_succeeded("0", [_text("Let me search."), tool_use], "tool_use"), _succeeded("1", [_text("Salam")], "end_turn")],
+            # Second round: only the conversation waiting on its tool result is sent again
+            [_succeeded("0", [_text("Allah is the Most Merciful.")], "end_turn")],
+        ]
+
+        histories = AnsariClaude.process_message_histories_in_batch(
+            get_settings(),
+            [
+                [{"id": 7, "role": "user", "content": "What does the Quran say about mercy?"}],
+                [{"role": "user", "content": "Salam"}],
+            ],
+            poll_interval=0,
+        )
+
+    first_round, second_round = (call.kwargs["requests"] for call in batches.create.call_args_list)
+    assert [request["custom_id"] for request in first_round] == ["0", "1"]
+    assert [request["custom_id"] for request in second_round] == ["0"]
+    assert "stream" not in first_round[0]["params"]
+    assert second_round[0]["params"]["messages"][-1]["content"][0]["type"] == "tool_result"
+    assert mock_sleep.call_count == 2
+
+    tool.run.assert_called_once_with("mercy")
+    assert [msg["role"] for msg in histories[0]] == ["user", "assistant", "user", "assistant"]
+    assert histories[0][-1]["content"] == [{"type": "text", "text": "Allah is the Most Merciful."}]
+    assert histories[1][-1]["content"] == [{"type": "text", "text": "Salam"}]
+
+
+def test_failed_batch_request_ends_conversation_with_error_message():
+    with (
+        patch("anthropic.Anthropic") as mock_anthropic,
+        patch.object(AnsariClaude, "_get_system_prompt", return_value="System prompt"),
+    ):
+        batches = mock_anthropic.return_value.messages.batches
+        batches.create.return_value = SimpleNamespace(id="batch_1", processing_status="ended")
+        batches.results.return_value = [SimpleNamespace(custom_id="0", result=SimpleNamespace(type="errored"))]
+
+        (history,) = AnsariClaude.process_message_histories_in_batch(get_settings(), [[{"role": "user", "content": "Salam"}]])
+
+    batches.create.assert_called_once()
+    assert history[-1]["role"] == "assistant"
+    assert "encountered a problem" in history[-1]["content"][0]["text"]
+
+
+def test_transient_error_while_polling_is_retried():
+    request = httpx.Request("GET", "https://api.anthropic.com/v1/messages/batches/batch_1")
+    with (
+        patch("anthropic.Anthropic") as mock_anthropic,
+        patch.object(AnsariClaude, "_get_system_prompt", return_value="System prompt"),
+        patch("ansari.agents.ansari_claude.time.sleep"),
+    ):
+        batches = mock_anthropic.return_value.messages.batches
+        batches.create.return_value = SimpleNamespace(id="batch_1", processing_status="in_progress")
+        batches.retrieve.side_effect = [
+            anthropic.APIConnectionError(request=request),
+            SimpleNamespace(id="batch_1", processing_status="ended"),
+        ]
+        batches.results.return_value = [_succeeded("0", [_text("Wa alaykum")], "end_turn")]
+
+        (history,) = AnsariClaude.process_message_histories_in_batch(
+            get_settings(), [[{"role": "user", "content": "Salam"}]], poll_interval=0
+        )
+
+    assert batches.retrieve.call_count == 2
+    assert history[-1]["content"] == [{"type": "text", "text": "Wa alaykum"}]
+
+
+def test_conversation_unanswered_after_the_last_round_ends_with_error_message():
+    tool = MagicMock()
+    tool.get_tool_description.return_value = {
+        "type": "function",
+        "function": {"name": "search_quran", "description": "Search the Quran", "parameters": {"type": "object"}},
+    }
+    tool.run.return_value = ["result"]
+    tool.format_as_tool_result.return_value = "result"
+    tool.format_as_ref_list.return_value = []
+    tool_use = SimpleNamespace(type="tool_use", id="tool_1", name="search_quran", input={"query": "mercy"})
+
+    with (
+        patch("anthropic.Anthropic") as mock_anthropic,
+        patch.object(AnsariClaude, "_initialize_tools", return_value={"search_quran": tool}),
+        patch.object(AnsariClaude, "_get_system_prompt", return_value="System prompt"),
+        patch("ansari.agents.ansari_claude.BATCH_MAX_ROUNDS", 1),
+    ):
+        batches = mock_anthropic.return_value.messages.batches
+        batches.create.return_value = SimpleNamespace(id="batch_1", processing_status="ended")
+        batches.results.return_value = [_succeeded("0", [tool_use], "tool_use")]
+
+        (history,) = AnsariClaude.process_message_histories_in_batch(
+            get_settings(), [[{"role": "user", "content": "What does the Quran say about mercy?"}]]
+        )
+
+    batches.create.assert_called_once()
+    assert history[-2]["content"][0]["type"] == "tool_result"
+    assert history[-1]["role"] == "assistant"
+    assert "encountered a problem" in history[-1]["content"][0]["text"]
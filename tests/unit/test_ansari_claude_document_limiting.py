@@ -160,6 +160,49 @@ class TestAnsariClaudeDocumentLimiting:
         expected_titles = [f"Document 1-{i}" for i in range(5, 30)]  # Documents 5-29 from message 1
         assert sorted(doc_titles) == sorted(expected_titles), f"Expected titles {expected_titles}, got {doc_titles}"
 
+    def test_original_history_preserved(self):
+        """Test that limiting documents never modifies self.message_history."""
+        original_history = [
+            self.create_message_with_docs("user", 20, 0),
+            {"role": "assistant", "content": [{"type": "text", "text": "First response"}]},
+            self.create_message_with_docs("user", 30, 1),
+        ]
+
+        self.ansari_claude.message_history = copy.deepcopy(original_history)
+        limited_history = self.ansari_claude.limit_documents_in_message_history(max_documents=25)
+
+        assert self._count_documents(limited_history) == 25
+        assert self.ansari_claude.message_history == original_history
+        # Messages without removed documents are shared rather than copied
+        assert limited_history[1] is self.ansari_claude.message_history[1]
+
+    def test_documents_nested_in_tool_results_are_limited(self):
+        """Test that documents inside tool_result content (as sent to Claude) count towards the limit."""
+
+        def tool_result_message(message_index, num_docs):
+            docs = self.create_message_with_docs("user", num_docs, message_index)["content"][1:]
+            stub = {"type": "text", "text": "Please see the references below."}
+            return {
+                "role": "user",
+                "content": [{"type": "tool_result", "tool_use_id": f"tool-{message_index}", "content": [stub, *docs]}],
+            }
+
+        original_history = [
+            tool_result_message(0, 20),
+            {"role": "assistant", "content": [{"type": "text", "text": "First response"}]},
+            tool_result_message(1, 30),
+        ]
+
+        self.ansari_claude.message_history = copy.deepcopy(original_history)
+        limited_history = self.ansari_claude.limit_documents_in_message_history(max_documents=25)
+
+        first_result, second_result = limited_history[0]["content"][0], limited_history[2]["content"][0]
+        # The oldest documents go first; the tool_result blocks and their text stubs stay
+        assert first_result["content"] == [{"type": "text", "text": "Please see the references below."}]
+        assert self._count_documents_in_message(second_result) == 25
+        assert self._get_document_titles(second_result)[0] == "Document 1-5"
+        assert self.ansari_claude.message_history == original_history
+
     def _count_documents(self, message_history):
         """Helper method to count document blocks in a message history."""
         count = 0
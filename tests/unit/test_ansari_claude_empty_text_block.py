@@ -13,6 +13,7 @@ class TestAnsariClaudeEmptyTextBlock(unittest.TestCase):
         # Mock settings
         self.settings = Settings()
         self.settings.ANTHROPIC_MODEL = "test-model"
+        self.settings.ANTHROPIC_ROUTING_MODEL = ""
         self.settings.ANTHROPIC_API_KEY = "test-key"
         self.settings.MAX_FAILURES = 1
 
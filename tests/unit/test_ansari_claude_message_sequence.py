@@ -1,3 +1,4 @@
+import threading
 import uuid
 import sys
 import os
@@ -7,7 +8,7 @@ from unittest.mock import MagicMock, patch
 src_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
 sys.path.insert(0, src_path)
 
-from ansari.agents.ansari_claude import AnsariClaude
+from ansari.agents.ansari_claude import LOOP_STUCK_MESSAGE, AnsariClaude
 from ansari.config import Settings
 from ansari.ansari_db import MessageLogger
 
@@ -25,6 +26,7 @@ def test_message_sequence_with_tool_use():
     # Create a mock settings object
     settings = MagicMock(spec=Settings)
     settings.ANTHROPIC_MODEL = "claude-3-opus-20240229"
+    settings.ANTHROPIC_ROUTING_MODEL = ""
     settings.diskcache_dir = "/tmp/diskcache"
     settings.MAX_FAILURES = 3
 
@@ -138,5 +140,245 @@ def test_message_sequence_with_tool_use():
         print("All assertions passed - message sequence with tool use/result is correctly processed!")
 
 
+def test_init_sets_up_per_agent_state(make_claude):
+    """Every per-conversation attribute with a class-level default is also set on the instance by __init__."""
+    claude = make_claude()
+
+    # Class attributes that are deliberately shared by all agents
+    shared = {"_claude_tool_cache", "_system_prompt_cache", "_chunk_handlers"}
+    per_agent = [
+        name
+        for name, value in vars(AnsariClaude).items()
+        if name.startswith("_") and not name.startswith("__") and name not in shared and not callable(value)
+    ]
+    assert "_log_write" in per_agent
+    assert [name for name in per_agent if name not in vars(claude)] == []
+
+
+def test_message_history_normalized_incrementally(make_claude):
+    """Messages already normalized by a previous call are not rescanned; newly appended ones are."""
+    claude = make_claude(message_logger=MagicMock(spec=MessageLogger))
+
+    tool_id = str(uuid.uuid4())
+    claude.message_history = [
+        {"role": "assistant", "content": [{"type": "tool_use", "id": tool_id, "name": "search_quran", "input": {}}]},
+        {"role": "user", "content": [{"type": "tool_result", "tool_use_id": tool_id, "content": "Found it."}]},
+        {"role": "assistant", "content": "Plain string answer"},
+        {"role": "user", "content": "Tell me more"},
+    ]
+
+    def mock_process_one_round(*args, **kwargs):
+        claude.message_history.append({"role": "assistant", "content": [{"type": "text", "text": "Done."}]})
+        return ["Done."]
+
+    claude.process_one_round = MagicMock(side_effect=mock_process_one_round)
+
+    list(claude.process_message_history(use_tool=False))
+    assert claude.message_history[2]["content"] == [{"type": "text", "text": "Plain string answer"}]
+    assert claude._tool_use_ids == {tool_id}
+    assert claude._normalized_upto == 4
+
+    # A message before the watermark is not touched again...
+    claude.message_history[2]["content"] = "Edited after normalization"
+    # ...but new messages are, and tool_use ids from earlier turns are still known
+    claude.message_history.append({"role": "assistant", "content": "Second plain answer"})
+    claude.message_history.append(
+        {
+            "role": "user",
+            "content": [
+                {"type": "tool_result", "tool_use_id": tool_id, "content": "Again."},
+                {"type": "tool_result", "tool_use_id": "unknown", "content": "Orphan."},
+            ],
+        }
+    )
+
+    list(claude.process_message_history(use_tool=False))
+    assert claude.message_history[2]["content"] == "Edited after normalization"
+    assert claude.message_history[5]["content"] == [{"type": "text", "text": "Second plain answer"}]
+    assert [b["tool_use_id"] for b in claude.message_history[6]["content"]] == [tool_id]
+
+    # Replacing the history invalidates the watermark and triggers a full rescan
+    claude.message_history = [dict(m) for m in claude.message_history[:4]]
+    list(claude.process_message_history(use_tool=False))
+    assert claude.message_history[2]["content"] == [{"type": "text", "text": "Edited after normalization"}]
+
+    # In-place edits before the watermark are picked up once the history is marked dirty
+    claude.message_history[0]["content"] = "Edited in place"
+    claude.message_history.append({"role": "user", "content": "One more question"})
+    claude.mark_history_dirty()
+    list(claude.process_message_history(use_tool=False))
+    assert claude.message_history[0]["content"] == [{"type": "text", "text": "Edited in place"}]
+
+
+def test_message_history_loop_detected_when_round_changes_nothing(make_claude):
+    """A round that leaves the history untouched ends processing with the loop message."""
+    claude = make_claude([{"role": "user", "content": "Hello"}], message_logger=MagicMock(spec=MessageLogger))
+    claude.process_one_round = MagicMock(return_value=[])
+
+    list(claude.process_message_history(use_tool=False))
+
+    assert claude.process_one_round.call_count == 1
+    assert claude.message_history[-1]["role"] == "assistant"
+    assert claude.message_history[-1]["content"][0]["text"] == LOOP_STUCK_MESSAGE
+
+
+def test_already_logged_user_message_is_not_logged_again(make_claude):
+    """A trailing user message that was already logged (e.g. a tool_result) is not logged a second time."""
+    claude = make_claude(message_logger=MagicMock(spec=MessageLogger))
+
+    user_message = {"role": "user", "content": "Hello"}
+    claude.message_history = [user_message]
+    claude._log_message(user_message)
+
+    def mock_process_one_round(*args, **kwargs):
+        claude.message_history.append({"role": "assistant", "content": [{"type": "text", "text": "Salam!"}]})
+        return ["Salam!"]
+
+    claude.process_one_round = MagicMock(side_effect=mock_process_one_round)
+    list(claude.process_message_history(use_tool=False))
+
+    logged = [call.args[0] for call in claude.message_logger.log.call_args_list]
+    assert logged.count(user_message) == 1
+
+
+def test_messages_logged_during_a_round_are_written_together(make_claude):
+    """The tool_use and tool_result messages of one round reach the logger in a single log_many call."""
+    claude = make_claude([{"role": "user", "content": "Hello"}], message_logger=MagicMock(spec=MessageLogger))
+
+    tool_use = {"role": "assistant", "content": [{"type": "tool_use", "id": "t1", "name": "search_quran", "input": {}}]}
+    tool_result = {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "t1", "content": "Found it."}]}
+    answer = {"role": "assistant", "content": [{"type": "text", "text": "Salam!"}]}
+
+    def mock_process_one_round(*args, **kwargs):
+        next_messages = [answer] if claude.message_history[-1] is tool_result else [tool_use, tool_result]
+        for message in next_messages:
+            claude.message_history.append(message)
+            claude._log_message(message, tool_name="search_quran" if message is tool_use else None)
+        return []
+
+    claude.process_one_round = MagicMock(side_effect=mock_process_one_round)
+    list(claude.process_message_history())
+
+    assert claude.message_logger.log_many.call_args_list[0].args[0] == [(tool_use, "search_quran"), (tool_result, None)]
+    assert claude.message_logger.log_many.call_args_list[1].args[0] == [(answer, None)]
+    # Only the initial user message is logged on its own
+    claude.message_logger.log.assert_called_once()
+
+
+def test_round_does_not_wait_for_the_previous_rounds_log_write(make_claude):
+    """Queued messages are written in the background while the next round runs, and the turn waits for the write."""
+    claude = make_claude([{"role": "user", "content": "Hello"}], message_logger=MagicMock(spec=MessageLogger))
+    claude._last_logged_message = claude.message_history[-1]
+
+    second_round_started = threading.Event()
+    written = []
+
+    def slow_log_many(messages):
+        # The first write only finishes once the second round is under way
+        second_round_started.wait(timeout=5)
+        written.extend(message for message, _ in messages)
+
+    claude.message_logger.log_many.side_effect = slow_log_many
+
+    tool_use = {"role": "assistant", "content": [{"type": "tool_use", "id": "t1", "name": "search_quran", "input": {}}]}
+    answer = {"role": "assistant", "content": [{"type": "text", "text": "Salam!"}]}
+
+    def mock_process_one_round(*args, **kwargs):
+        if claude.message_history[-1]["role"] == "user" and len(claude.message_history) == 1:
+            claude.message_history.append(tool_use)
+            claude._log_message(tool_use, tool_name="search_quran")
+            claude.message_history.append({"role": "user", "content": "tool result"})
+        else:
+            second_round_started.set()
+            claude.message_history.append(answer)
+            claude._log_message(answer)
+        return []
+
+    claude.process_one_round = MagicMock(side_effect=mock_process_one_round)
+    list(claude.process_message_history())
+
+    assert second_round_started.is_set()
+    assert written == [tool_use, answer]
+
+
+def test_background_log_write_is_not_affected_by_later_history_repairs(make_claude):
+    """The log writer gets copies of the queued messages, so editing the history in place meanwhile is safe."""
+    claude = make_claude(message_logger=MagicMock(spec=MessageLogger))
+
+    release = threading.Event()
+    written = []
+
+    def slow_log_many(messages):
+        release.wait(timeout=5)
+        written.extend(message for message, _ in messages)
+
+    claude.message_logger.log_many.side_effect = slow_log_many
+
+    blocks = [
+        {"type": "tool_result", "tool_use_id": "t1", "content": "Found it."},
+        {"type": "tool_result", "tool_use_id": "orphan", "content": "No matching tool_use."},
+    ]
+    message = {"role": "user", "content": list(blocks)}
+    claude.message_history.append(message)
+    with claude._batched_logging():
+        claude._log_message(message, trusted=True)
+
+    # A repair in the next round edits the logged message while it is being written
+    message["content"].pop(1)
+    message["content"][0]["content"] = []
+    release.set()
+    claude._wait_for_log_writes()
+
+    assert written == [
+        {
+            "role": "user",
+            "content": [
+                {"type": "tool_result", "tool_use_id": "t1", "content": "Found it."},
+                {"type": "tool_result", "tool_use_id": "orphan", "content": "No matching tool_use."},
+            ],
+        }
+    ]
+    # The history itself was edited
+    assert message["content"] == [{"type": "tool_result", "tool_use_id": "t1", "content": []}]
+
+
+def test_history_ending_with_assistant_is_returned_untouched(make_claude):
+    """Nothing is normalized, logged or sent when the history already ends with an assistant message."""
+    claude = make_claude(message_logger=MagicMock(spec=MessageLogger))
+    claude.message_history = [
+        {"role": "user", "content": "Hello"},
+        {"role": "assistant", "content": "Salam!"},
+    ]
+    claude.process_one_round = MagicMock(return_value=[])
+
+    assert list(claude.process_message_history()) == []
+
+    claude.process_one_round.assert_not_called()
+    claude.message_logger.log.assert_not_called()
+    assert claude.message_history[-1]["content"] == "Salam!"
+
+
 if __name__ == "__main__":
     test_message_sequence_with_tool_use()
+
+
+def test_log_writes_of_different_agents_do_not_wait_for_each_other(make_claude):
+    """Each agent has its own log writer, so a slow write in one conversation doesn't hold up another's."""
+    release = threading.Event()
+    slow = make_claude(message_logger=MagicMock(spec=MessageLogger))
+    slow.message_logger.log_many.side_effect = lambda messages: release.wait(timeout=5)
+    fast = make_claude(message_logger=MagicMock(spec=MessageLogger))
+
+    message = {"role": "assistant", "content": [{"type": "text", "text": "Salam!"}]}
+    try:
+        with slow._batched_logging():
+            slow._log_message(message, trusted=True)
+        with fast._batched_logging():
+            fast._log_message(message, trusted=True)
+
+        fast._log_write.result(timeout=2)
+        fast.message_logger.log_many.assert_called_once()
+        assert not slow._log_write.done()
+    finally:
+        release.set()
+        slow._wait_for_log_writes()
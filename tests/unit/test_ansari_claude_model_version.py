@@ -11,6 +11,8 @@ def mock_settings():
     settings.ANTHROPIC_API_KEY = MagicMock()
     settings.ANTHROPIC_API_KEY.get_secret_value.return_value = "test-api-key"
     settings.ANTHROPIC_MODEL = "claude-sonnet-4-5"
+    settings.ANTHROPIC_ROUTING_MODEL = ""
+    settings.TOOL_EXECUTOR_MAX_WORKERS = 16
     settings.KALEMAT_API_KEY = MagicMock()
     settings.KALEMAT_API_KEY.get_secret_value.return_value = "test-kalemat-key"
     settings.VECTARA_API_KEY = MagicMock()
@@ -79,6 +81,18 @@ class TestAnsariClaudeModelVersion:
             call_args = mock_client.messages.create.call_args
             assert call_args[1]["model"] == "claude-sonnet-4-5"
 
+    def test_agents_share_http_connection_pool(self, mock_settings):
+        """Test that every AnsariClaude client is built on the same HTTP client, so connections are reused."""
+        with patch("anthropic.Anthropic") as mock_anthropic, patch("ansari.agents.ansari.PromptMgr"):
+            from src.ansari.agents.ansari_claude import AnsariClaude
+
+            AnsariClaude(mock_settings)
+            AnsariClaude(mock_settings)
+
+            first_call, second_call = mock_anthropic.call_args_list
+            assert first_call.kwargs["http_client"] is not None
+            assert first_call.kwargs["http_client"] is second_call.kwargs["http_client"]
+
     def test_default_config_uses_sonnet_4_5(self):
         """Test that the default configuration in Settings uses Sonnet 4.5."""
         from src.ansari.config import Settings
@@ -0,0 +1,420 @@
+import sys
+import os
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import anthropic
+import httpx
+import pytest
+
+# Add the src directory to the path so we can import the modules
+src_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.insert(0, src_path)
+
+from ansari.agents.ansari_claude import STREAM_FLUSH_MAX_DELAY, AnsariClaude, _TextCoalescer
+
+
+def _text_stream(deltas):
+    """Build a minimal Anthropic-style event stream that streams `deltas` as one text block."""
+    usage = SimpleNamespace(input_tokens=12, cache_read_input_tokens=3000, cache_creation_input_tokens=0)
+    chunks = [
+        SimpleNamespace(type="message_start", message=SimpleNamespace(usage=usage)),
+        SimpleNamespace(type="content_block_start", content_block=SimpleNamespace(type="text", text="")),
+    ]
+    chunks += [SimpleNamespace(type="content_block_delta", delta=SimpleNamespace(type="text_delta", text=d)) for d in deltas]
+    chunks += [
+        SimpleNamespace(type="content_block_stop"),
+        SimpleNamespace(type="message_delta", delta=SimpleNamespace(stop_reason="end_turn")),
+        SimpleNamespace(type="message_stop"),
+    ]
+    return chunks
+
+
+def test_text_coalescer_releases_first_delta_immediately():
+    buffer = _TextCoalescer(min_chars=10, max_delay=60)
+
+    assert buffer.add("Hi") == "Hi"
+    assert buffer.add(" there") == ""
+    assert buffer.add(", friend") == " there, friend"
+    assert buffer.add("!") == ""
+    assert buffer.flush() == "!"
+    assert buffer.flush() == ""
+
+
+def test_process_one_round_coalesces_small_text_deltas(make_claude):
+    claude = make_claude([{"role": "user", "content": "Hello"}])
+    deltas = ["As"] + ["-sal", "amu", " ", "alay", "kum"] * 10
+    claude.client.messages.create.return_value = iter(_text_stream(deltas))
+
+    chunks = list(claude.process_one_round())
+
+    # Nothing is lost or reordered, but far fewer chunks reach the caller than deltas were streamed
+    assert "".join(chunks) == "".join(deltas)
+    assert chunks[0] == "As"
+    assert len(chunks) < len(deltas)
+
+    # The assistant message in history holds the complete text
+    assert claude.message_history[-1]["role"] == "assistant"
+    assert claude.message_history[-1]["content"][0]["text"] == "".join(deltas)
+
+
+def test_citation_after_a_pause_keeps_the_buffered_text(make_claude):
+    claude = make_claude([{"role": "user", "content": "Hello"}])
+    citation = SimpleNamespace(cited_text="English: In the name of God", document_title="Quran 1:1")
+    chunks = _text_stream(["Hello", " world"])
+    cited = SimpleNamespace(type="content_block_delta", delta=SimpleNamespace(type="citations_delta", citation=citation))
+
+    def stream():
+        for i, chunk in enumerate(chunks):
+            if i == 4:
+                # " world" is still buffered when the citation arrives after the flush delay has passed
+                time.sleep(STREAM_FLUSH_MAX_DELAY + 0.01)
+                yield cited
+            yield chunk
+
+    claude.client.messages.create.return_value = stream()
+
+    output = list(claude.process_one_round())
+
+    assert "" not in output
+    assert output[:2] == ["Hello", " world [1] "]
+    assert claude.message_history[-1]["content"][0]["text"].startswith("Hello world [1]")
+
+
+def test_empty_text_deltas_are_skipped(make_claude):
+    claude = make_claude([{"role": "user", "content": "Hello"}])
+    claude.client.messages.create.return_value = iter(_text_stream(["", "Salam", "", " alaykum"]))
+
+    chunks = list(claude.process_one_round())
+
+    # An empty first delta doesn't hold back the first real text
+    assert chunks[0] == "Salam"
+    assert "".join(chunks) == "Salam alaykum"
+    assert claude.message_history[-1]["content"][0]["text"] == "Salam alaykum"
+
+
+def test_process_one_round_assembles_tool_arguments_from_fragments(make_claude):
+    claude = make_claude([{"role": "user", "content": "Hello"}])
+    tool = MagicMock()
+    tool.run.return_value = ["result"]
+    tool.format_as_tool_result.return_value = "result"
+    tool.format_as_ref_list.return_value = [
+        {"type": "document", "source": {"type": "text", "media_type": "text/plain", "data": "Verse"}}
+    ]
+    claude.tool_name_to_instance = {"search_quran": tool}
+
+    fragments = ['{"que', 'ry": "mer', 'cy"}']
+    claude.client.messages.create.return_value = iter(
+        [
+            SimpleNamespace(
+                type="content_block_start",
+                content_block=SimpleNamespace(type="tool_use", id="tool_1", name="search_quran"),
+            ),
+            *[
+                SimpleNamespace(type="content_block_delta", delta=SimpleNamespace(type="input_json_delta", partial_json=f))
+                for f in fragments
+            ],
+            SimpleNamespace(type="content_block_stop"),
+            SimpleNamespace(type="message_delta", delta=SimpleNamespace(stop_reason="tool_use")),
+            SimpleNamespace(type="message_stop"),
+        ]
+    )
+
+    list(claude.process_one_round())
+
+    tool.run.assert_called_once_with("mercy")
+    assert claude.message_history[-2]["content"] == [
+        {"type": "tool_use", "id": "tool_1", "name": "search_quran", "input": {"query": "mercy"}}
+    ]
+    assert claude.message_history[-1]["content"][0]["tool_use_id"] == "tool_1"
+
+
+def test_system_prompt_rendered_once_per_process(make_claude):
+    with (
+        patch("ansari.agents.ansari_claude.PromptMgr") as mock_prompt_mgr,
+        patch.dict(AnsariClaude._system_prompt_cache, clear=True),
+    ):
+        mock_prompt_mgr.return_value.bind.return_value.render.return_value = "System prompt"
+
+        # Two rounds on each of two agents
+        for _ in range(2):
+            claude = make_claude([{"role": "user", "content": "Hello"}], DEV_MODE=False)
+            claude.client.messages.create.side_effect = lambda **kwargs: iter(_text_stream(["Salam"]))
+            for _ in range(2):
+                claude.message_history.append({"role": "user", "content": "Hello"})
+                list(claude.process_one_round())
+
+    mock_prompt_mgr.return_value.bind.assert_called_once_with("system_msg_claude")
+    for call in claude.client.messages.create.call_args_list:
+        assert call.kwargs["system"][0]["text"] == "System prompt"
+
+
+def test_system_prompt_rerendered_each_round_in_dev_mode(make_claude):
+    with (
+        patch("ansari.agents.ansari_claude.PromptMgr") as mock_prompt_mgr,
+        patch.dict(AnsariClaude._system_prompt_cache, clear=True),
+    ):
+        mock_prompt_mgr.return_value.bind.return_value.render.return_value = "System prompt"
+
+        claude = make_claude([{"role": "user", "content": "Hello"}], DEV_MODE=True)
+        claude.client.messages.create.side_effect = lambda **kwargs: iter(_text_stream(["Salam"]))
+        for _ in range(2):
+            claude.message_history.append({"role": "user", "content": "Hello"})
+            list(claude.process_one_round())
+
+    assert mock_prompt_mgr.return_value.bind.call_count == 2
+
+
+def test_cache_breakpoints_on_last_two_messages_only_in_request(make_claude):
+    claude = make_claude([{"role": "user", "content": "Hello"}])
+    claude.message_history = [
+        {"role": "user", "content": "First question"},
+        {"role": "assistant", "content": [{"type": "text", "text": "First answer"}]},
+        {"role": "user", "content": "Second question"},
+    ]
+    claude.client.messages.create.return_value = iter(_text_stream(["Salam"]))
+
+    list(claude.process_one_round())
+
+    sent = claude.client.messages.create.call_args.kwargs["messages"]
+    assert "cache_control" not in str(sent[0])
+    assert sent[1]["content"][-1]["cache_control"] == {"type": "ephemeral"}
+    assert sent[2]["content"] == [{"type": "text", "text": "Second question", "cache_control": {"type": "ephemeral"}}]
+    # The stored history itself never carries the markers
+    assert "cache_control" not in str(claude.message_history)
+
+
+def test_routing_model_only_answers_new_questions(make_claude):
+    claude = make_claude([{"role": "user", "content": "Hello"}])
+    claude.client.messages.create.side_effect = lambda **kwargs: iter(_text_stream(["Salam"]))
+    tool_result = {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "tool-1", "content": "Results"}]}
+
+    claude.settings.ANTHROPIC_ROUTING_MODEL = "claude-haiku-4-5"
+    list(claude.process_one_round())
+    claude.message_history.append(tool_result)
+    list(claude.process_one_round())
+
+    # Without a routing model every round uses the main model
+    claude.settings.ANTHROPIC_ROUTING_MODEL = ""
+    claude.message_history.append({"role": "user", "content": "Another question"})
+    list(claude.process_one_round())
+
+    models = [call.kwargs["model"] for call in claude.client.messages.create.call_args_list]
+    assert models == ["claude-haiku-4-5", "claude-3-opus-20240229", "claude-3-opus-20240229"]
+
+
+def _api_request():
+    return httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+
+
+def test_api_call_retries_transient_errors_with_backoff(make_claude):
+    claude = make_claude([{"role": "user", "content": "Hello"}])
+    claude.client.messages.create.side_effect = [
+        anthropic.APIConnectionError(request=_api_request()),
+        iter(_text_stream(["Salam"])),
+    ]
+
+    with patch("ansari.agents.ansari_claude.time.sleep") as mock_sleep:
+        chunks = list(claude.process_one_round())
+
+    assert "".join(chunks) == "Salam"
+    assert claude.client.messages.create.call_count == 2
+    mock_sleep.assert_called_once()
+    assert mock_sleep.call_args.args[0] < 5
+
+
+def test_api_call_honors_retry_after_header(make_claude):
+    claude = make_claude([{"role": "user", "content": "Hello"}])
+    response = httpx.Response(429, headers={"retry-after": "2"}, request=_api_request())
+    claude.client.messages.create.side_effect = [
+        anthropic.RateLimitError("rate limited", response=response, body=None),
+        iter(_text_stream(["Salam"])),
+    ]
+
+    with patch("ansari.agents.ansari_claude.time.sleep") as mock_sleep:
+        list(claude.process_one_round())
+
+    mock_sleep.assert_called_once_with(2.0)
+
+
+def test_api_call_does_not_retry_bad_requests(make_claude):
+    claude = make_claude([{"role": "user", "content": "Hello"}])
+    response = httpx.Response(400, request=_api_request())
+    claude.client.messages.create.side_effect = anthropic.BadRequestError("bad request", response=response, body=None)
+
+    with (
+        patch("ansari.agents.ansari_claude.time.sleep") as mock_sleep,
+        patch("ansari.agents.ansari_claude.get_settings") as mock_get_settings,
+    ):
+        mock_get_settings.return_value.DEV_MODE = False
+        with pytest.raises(anthropic.BadRequestError):
+            list(claude.process_one_round())
+
+    assert claude.client.messages.create.call_count == 1
+    mock_sleep.assert_not_called()
+
+
+def test_tool_call_in_end_turn_response_runs_once(make_claude):
+    claude = make_claude([{"role": "user", "content": "Hello"}])
+    tool = MagicMock()
+    tool.run.return_value = ["result"]
+    tool.format_as_tool_result.return_value = "result"
+    tool.format_as_ref_list.return_value = [
+        {"type": "document", "source": {"type": "text", "media_type": "text/plain", "data": "Verse"}}
+    ]
+    claude.tool_name_to_instance = {"search_quran": tool}
+    claude.client.messages.create.return_value = iter(
+        [
+            SimpleNamespace(
+                type="content_block_start",
+                content_block=SimpleNamespace(type="tool_use", id="tool_1", name="search_quran"),
+            ),
+            SimpleNamespace(
+                type="content_block_delta", delta=SimpleNamespace(type="input_json_delta", partial_json='{"query": "mercy"}')
+            ),
+            SimpleNamespace(type="content_block_stop"),
+            SimpleNamespace(type="message_delta", delta=SimpleNamespace(stop_reason="end_turn")),
+            SimpleNamespace(type="message_stop"),
+        ]
+    )
+
+    list(claude.process_one_round())
+
+    tool.run.assert_called_once_with("mercy")
+    assert [m["role"] for m in claude.message_history] == ["user", "assistant", "user"]
+
+
+def test_tool_call_starts_before_response_finishes_streaming(make_claude):
+    claude = make_claude([{"role": "user", "content": "Hello"}])
+    search_started = threading.Event()
+    tool = MagicMock()
+    tool.run.side_effect = lambda query: search_started.set() or ["result"]
+    tool.format_as_tool_result.return_value = "result"
+    tool.format_as_ref_list.return_value = [
+        {"type": "document", "source": {"type": "text", "media_type": "text/plain", "data": "Verse"}}
+    ]
+    claude.tool_name_to_instance = {"search_quran": tool}
+    started_while_streaming = []
+
+    def stream():
+        yield SimpleNamespace(
+            type="content_block_start", content_block=SimpleNamespace(type="tool_use", id="tool_1", name="search_quran")
+        )
+        yield SimpleNamespace(
+            type="content_block_delta", delta=SimpleNamespace(type="input_json_delta", partial_json='{"query": "mercy"}')
+        )
+        yield SimpleNamespace(type="content_block_stop")
+        # The rest of the turn is still being streamed when the search runs
+        started_while_streaming.append(search_started.wait(timeout=5))
+        yield SimpleNamespace(type="message_delta", delta=SimpleNamespace(stop_reason="tool_use"))
+        yield SimpleNamespace(type="message_stop")
+
+    claude.client.messages.create.return_value = stream()
+
+    list(claude.process_one_round())
+
+    assert started_while_streaming == [True]
+    tool.run.assert_called_once_with("mercy")
+    assert claude.message_history[-1]["content"][0]["tool_use_id"] == "tool_1"
+
+
+def test_citation_delta_yields_reference_marker(make_claude):
+    claude = make_claude([{"role": "user", "content": "Hello"}])
+    citation = SimpleNamespace(cited_text="English: In the name of God", document_title="Quran 1:1")
+    chunks = _text_stream(["Bismillah"])
+    chunks.insert(
+        3, SimpleNamespace(type="content_block_delta", delta=SimpleNamespace(type="citations_delta", citation=citation))
+    )
+    claude.client.messages.create.return_value = iter(chunks)
+
+    output = "".join(claude.process_one_round())
+
+    assert output.startswith("Bismillah [1] ")
+    assert claude.citations == [citation]
+    assert "[1] Quran 1:1:\nEnglish: In the name of God" in claude.message_history[-1]["content"][0]["text"]
+
+
+def test_citation_is_translated_while_response_streams(make_claude):
+    claude = make_claude([{"role": "user", "content": "Hello"}])
+    citation = SimpleNamespace(cited_text="بسم الله الرحمن الرحيم", document_title="Quran 1:1")
+    translation_started = threading.Event()
+    translated_while_streaming = []
+
+    def translate(texts, context="citation"):
+        translation_started.set()
+        return ["In the name of God"]
+
+    def stream():
+        yield from _text_stream(["Bismillah"])[:3]
+        yield SimpleNamespace(type="content_block_delta", delta=SimpleNamespace(type="citations_delta", citation=citation))
+        # The rest of the response is still being streamed when the citation is translated
+        translated_while_streaming.append(translation_started.wait(timeout=5))
+        yield from _text_stream([])[2:]
+
+    claude.client.messages.create.return_value = stream()
+
+    with patch.object(claude, "_translate_with_event_loop_safety", side_effect=translate) as mock_translate:
+        list(claude.process_one_round())
+
+    assert translated_while_streaming == [True]
+    mock_translate.assert_called_once()
+    assert (
+        "[1] Quran 1:1:\n Arabic: بسم الله الرحمن الرحيم\n\n English: In the name of God"
+        in (claude.message_history[-1]["content"][0]["text"])
+    )
+
+
+def test_citation_is_rendered_while_searches_fill_the_tool_pool(make_claude):
+    claude = make_claude([{"role": "user", "content": "Hello"}], TOOL_EXECUTOR_MAX_WORKERS=1)
+    citation = SimpleNamespace(cited_text="بسم الله الرحمن الرحيم", document_title="Quran 1:1")
+    search_done = threading.Event()
+    translation_started = threading.Event()
+    translated_while_searching = []
+
+    def translate(texts, context="citation"):
+        translation_started.set()
+        return ["In the name of God"]
+
+    def stream():
+        yield from _text_stream(["Bismillah"])[:3]
+        yield SimpleNamespace(type="content_block_delta", delta=SimpleNamespace(type="citations_delta", citation=citation))
+        translated_while_searching.append(translation_started.wait(timeout=5))
+        search_done.set()
+        yield from _text_stream([])[2:]
+
+    claude.client.messages.create.return_value = stream()
+    # A slow search holds the only worker in the tool pool
+    claude._tool_executor.submit(search_done.wait, 10)
+
+    with patch.object(claude, "_translate_with_event_loop_safety", side_effect=translate):
+        list(claude.process_one_round())
+
+    assert translated_while_searching == [True]
+
+
+def test_citations_list_only_covers_the_current_turn(make_claude):
+    claude = make_claude([{"role": "user", "content": "Hello"}])
+
+    def cited_answer(text, citation):
+        chunks = _text_stream([text])
+        delta = SimpleNamespace(type="citations_delta", citation=citation)
+        chunks.insert(3, SimpleNamespace(type="content_block_delta", delta=delta))
+        return iter(chunks)
+
+    first = SimpleNamespace(cited_text="English: In the name of God", document_title="Quran 1:1")
+    second = SimpleNamespace(cited_text="English: All praise is due to God", document_title="Quran 1:2")
+    claude.client.messages.create.side_effect = [cited_answer("Bismillah", first), cited_answer("Alhamdulillah", second)]
+
+    list(claude.process_message_history())
+    claude.message_history.append({"role": "user", "content": "And the next verse?"})
+    output = "".join(claude.process_message_history())
+
+    # Numbering runs on across the conversation, but earlier turns' citations are not listed again
+    assert output.startswith("Alhamdulillah [2] ")
+    answer = claude.message_history[-1]["content"][0]["text"]
+    assert "[2] Quran 1:2:\nEnglish: All praise is due to God" in answer
+    assert "Quran 1:1" not in answer
+    # Only the current turn's citations are kept
+    assert claude.citations == [second]
@@ -11,6 +11,7 @@ def mock_settings():
     settings.ANTHROPIC_API_KEY = MagicMock()
     settings.ANTHROPIC_API_KEY.get_secret_value.return_value = "test-api-key"
     settings.ANTHROPIC_MODEL = "claude-3-opus-20240229"
+    settings.ANTHROPIC_ROUTING_MODEL = ""
     settings.KALEMAT_API_KEY = MagicMock()
     settings.KALEMAT_API_KEY.get_secret_value.return_value = "test-kalemat-key"
     settings.VECTARA_API_KEY = MagicMock()
@@ -9,6 +9,7 @@ sys.path.insert(0, src_path)
 from unittest.mock import MagicMock, patch
 from ansari.agents.ansari_claude import AnsariClaude
 from ansari.config import Settings
+from ansari.util.translation import format_multilingual_data
 
 
 def test_process_message_history_with_tools():
@@ -17,6 +18,7 @@ def test_process_message_history_with_tools():
     # Create mock settings
     settings = MagicMock(spec=Settings)
     settings.ANTHROPIC_MODEL = "claude-3-opus-20240229"
+    settings.ANTHROPIC_ROUTING_MODEL = ""
 
     # Create a unique tool ID for testing
     tool_id = str(uuid.uuid4())
@@ -55,6 +57,7 @@ def test_process_message_history_with_tools():
         claude.settings = settings
         claude.message_history = test_history.copy()
         claude.message_logger = None
+        claude.citations = []
         claude.client = MagicMock()
 
         # Add a final assistant response to avoid infinite loop
@@ -99,5 +102,168 @@ def test_process_message_history_with_tools():
         print("All assertions passed - message processing correctly handled tool relationships!")
 
 
+def test_replaced_history_drops_legacy_no_results_content(make_claude):
+    """Stored tool_results whose content is the legacy ["No results found."] are cleaned when a history is restored."""
+    claude = make_claude()
+
+    def add_assistant_response(*args, **kwargs):
+        claude.message_history.append({"role": "assistant", "content": [{"type": "text", "text": "Test response"}]})
+        return []
+
+    claude.process_one_round = MagicMock(side_effect=add_assistant_response)
+    stored_history = [
+        {"id": 1, "role": "user", "content": "What does the Quran say about patience?"},
+        {"id": 2, "role": "assistant", "content": [{"type": "tool_use", "id": "tool_1", "name": "search_quran", "input": {}}]},
+        {
+            "id": 3,
+            "role": "user",
+            "content": [{"type": "tool_result", "tool_use_id": "tool_1", "content": ["No results found."]}],
+        },
+        {"id": 4, "role": "assistant", "content": "I could not find anything."},
+        {"id": 5, "role": "user", "content": "Try again"},
+    ]
+
+    list(claude.replace_message_history(stored_history))
+
+    assert claude.message_history[2]["content"] == [{"type": "tool_result", "tool_use_id": "tool_1"}]
+    assert claude.message_history[3]["content"] == [{"type": "text", "text": "I could not find anything."}]
+    assert all("id" not in msg for msg in claude.message_history)
+    claude.process_one_round.assert_called_once()
+
+
 if __name__ == "__main__":
     test_process_message_history_with_tools()
+
+
+def test_multiple_tool_calls_run_concurrently_and_keep_order(make_claude):
+    """Tool calls from one turn run at the same time, and their results keep the tool_use order."""
+    import threading
+
+    claude = make_claude()
+
+    # Each search waits for the other one; run sequentially, the barrier would time out
+    barrier = threading.Barrier(2, timeout=5)
+
+    def make_tool(name):
+        tool = MagicMock()
+        tool.run.side_effect = lambda query: barrier.wait() and [] or [query]
+        tool.format_as_tool_result.side_effect = lambda results: results
+        tool.format_as_ref_list.side_effect = lambda results: [
+            {"type": "document", "source": {"type": "text", "media_type": "text/plain", "data": name}}
+        ]
+        return tool
+
+    claude.tool_name_to_instance = {"search_quran": make_tool("quran"), "search_hadith": make_tool("hadith")}
+    tool_calls = [
+        {"type": "tool_use", "id": "tool_1", "name": "search_quran", "input": {"query": "mercy"}},
+        {"type": "tool_use", "id": "tool_2", "name": "search_hadith", "input": {"query": "mercy"}},
+    ]
+
+    claude._process_tool_calls(tool_calls)
+
+    results = claude.message_history[-1]["content"]
+    assert [r["tool_use_id"] for r in results] == ["tool_1", "tool_2"]
+    assert all("is_error" not in r for r in results)
+    assert "quran" in results[0]["content"][1]["source"]["data"]
+    assert "hadith" in results[1]["content"][1]["source"]["data"]
+    assert claude.tool_usage_history == ["search_quran", "search_hadith"]
+
+
+def test_agents_run_searches_in_their_own_pools(make_claude):
+    """A full tool pool in one conversation doesn't hold up searches in another."""
+    import threading
+
+    release = threading.Event()
+
+    def make_agent(run):
+        claude = make_claude(TOOL_EXECUTOR_MAX_WORKERS=1)
+        tool = MagicMock()
+        tool.run.side_effect = run
+        tool.format_as_tool_result.side_effect = lambda results: results
+        tool.format_as_ref_list.return_value = []
+        claude.tool_name_to_instance = {"search_quran": tool}
+        return claude
+
+    busy = make_agent(lambda query: release.wait(5) and [query])
+    idle = make_agent(lambda query: [query])
+    tool_calls = [{"type": "tool_use", "id": "tool_1", "name": "search_quran", "input": {"query": "mercy"}}]
+
+    busy_turn = threading.Thread(target=busy._process_tool_calls, args=(tool_calls,))
+    busy_turn.start()
+    try:
+        idle_turn = threading.Thread(target=idle._process_tool_calls, args=(tool_calls,))
+        idle_turn.start()
+        idle_turn.join(2)
+        assert not idle_turn.is_alive()
+        assert idle.message_history[-1]["content"][0]["tool_use_id"] == "tool_1"
+    finally:
+        release.set()
+        busy_turn.join(5)
+
+    assert busy._tool_executor is not idle._tool_executor
+
+
+def test_validate_message_history_only_scans_new_messages(make_claude):
+    """Validation keeps the IDs it collected, so only appended messages are scanned on later rounds."""
+    claude = make_claude()
+    document = {"type": "document", "source": {"type": "text", "media_type": "text/plain", "data": "Verse"}}
+    claude.message_history = [
+        {"role": "user", "content": "What does the Quran say about mercy?"},
+        {"role": "assistant", "content": [{"type": "tool_use", "id": "tool_1", "name": "search_quran", "input": {}}]},
+        {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "tool_1", "content": [document]}]},
+    ]
+    claude._fix_tool_use_result_relationship = MagicMock()
+
+    claude._validate_message_history()
+    claude._fix_tool_use_result_relationship.assert_not_called()
+
+    # A tool_use without a result in a newly appended message is still detected
+    claude.message_history.append(
+        {"role": "assistant", "content": [{"type": "tool_use", "id": "tool_2", "name": "search_quran", "input": {}}]}
+    )
+    claude.message_history.append({"role": "user", "content": "Thanks"})
+    claude._validate_message_history()
+    claude._fix_tool_use_result_relationship.assert_called_once()
+
+    # A replaced history is scanned from the start, so the unanswered tool_2 from before is forgotten
+    claude._fix_tool_use_result_relationship.reset_mock()
+    claude.message_history = claude.message_history[:3]
+    claude._validate_message_history()
+    claude._fix_tool_use_result_relationship.assert_not_called()
+
+
+def test_tool_results_are_logged_without_revalidation(make_claude):
+    """Tool result messages assembled by the agent are logged as-is, including bare error results."""
+    claude = make_claude(message_logger=MagicMock())
+    failing_tool = MagicMock()
+    failing_tool.run.side_effect = RuntimeError("search backend down")
+    claude.tool_name_to_instance = {"search_quran": failing_tool}
+
+    with patch.object(AnsariClaude, "validate_message") as mock_validate:
+        claude._process_tool_calls([{"type": "tool_use", "id": "tool_1", "name": "search_quran", "input": {"query": "x"}}])
+
+    mock_validate.assert_not_called()
+    claude.message_logger.log.assert_called_once_with(claude.message_history[-1], tool_name=None)
+    assert claude.message_history[-1]["content"][0]["is_error"] is True
+
+
+def test_tool_result_documents_are_formatted_copies_of_the_references(make_claude):
+    """Reference documents are formatted into the tool_result without modifying the tool's own reference list."""
+    claude = make_claude()
+    data = format_multilingual_data({"ar": "بسم الله", "en": "In the name of God"})
+    reference = {
+        "type": "document",
+        "title": "Quran 1:1",
+        "source": {"type": "text", "media_type": "text/plain", "data": data},
+    }
+    tool = MagicMock()
+    tool.format_as_ref_list.return_value = [reference]
+    claude.tool_name_to_instance = {"search_quran": tool}
+
+    claude._process_tool_calls([{"type": "tool_use", "id": "tool_1", "name": "search_quran", "input": {"query": "x"}}])
+
+    stub, document = claude.message_history[-1]["content"][0]["content"]
+    assert stub == {"type": "text", "text": "Please see the references below."}
+    assert document["source"]["data"] == "Arabic: بسم الله\n\nEnglish: In the name of God"
+    assert document["title"] == "Quran 1:1"
+    assert reference["source"]["data"] == data
@@ -0,0 +1,34 @@
+import sys
+import os
+
+import httpx
+import litellm
+
+# Add the src directory to the path so we can import the modules
+src_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.insert(0, src_path)
+
+from ansari.agents.ansari import RETRY_INITIAL_WAIT, RETRY_MAX_WAIT, _is_retryable_completion_error, _retry_delay
+
+
+def _rate_limit_error(headers=None):
+    response = httpx.Response(429, headers=headers, request=httpx.Request("POST", "https://api.openai.com/v1"))
+    return litellm.RateLimitError("Rate limited", "openai", "gpt-4o", response=response)
+
+
+def test_retry_delay_grows_exponentially_up_to_the_cap():
+    assert RETRY_INITIAL_WAIT <= _retry_delay(1) <= 2 * RETRY_INITIAL_WAIT
+    assert 4 * RETRY_INITIAL_WAIT <= _retry_delay(3) <= 5 * RETRY_INITIAL_WAIT
+    assert _retry_delay(20) <= RETRY_MAX_WAIT + RETRY_INITIAL_WAIT
+
+
+def test_retry_delay_honors_retry_after_header():
+    assert _retry_delay(1, _rate_limit_error({"retry-after": "3"})) == 3.0
+    assert _retry_delay(1, _rate_limit_error({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})) <= 2 * RETRY_INITIAL_WAIT
+
+
+def test_only_transient_errors_are_retried():
+    assert _is_retryable_completion_error(_rate_limit_error())
+    assert _is_retryable_completion_error(litellm.APIConnectionError("Connection reset", "openai", "gpt-4o"))
+    assert not _is_retryable_completion_error(litellm.BadRequestError("Bad request", "gpt-4o", "openai"))
+    assert not _is_retryable_completion_error(KeyError("query"))
@@ -30,6 +30,8 @@ def test_ayah_claude_endpoint_loads_correct_system_prompt():
         mock_settings = MagicMock()
         mock_settings.ANTHROPIC_API_KEY.get_secret_value.return_value = "test-key"
         mock_settings.ANTHROPIC_MODEL = "claude-3-opus-20240229"
+        mock_settings.ANTHROPIC_ROUTING_MODEL = ""
+        mock_settings.TOOL_EXECUTOR_MAX_WORKERS = 16
         mock_settings.KALEMAT_API_KEY.get_secret_value.return_value = "test-key"
         mock_settings.VECTARA_API_KEY.get_secret_value.return_value = "test-key"
         mock_settings.USUL_API_TOKEN.get_secret_value.return_value = "test-key"
@@ -18,6 +18,7 @@ def test_logging_changes_dont_break_basic_functionality():
     # Create a mock settings object
     settings = MagicMock(spec=Settings)
     settings.ANTHROPIC_MODEL = "claude-3-opus-20240229"
+    settings.ANTHROPIC_ROUTING_MODEL = ""
     settings.MAX_FAILURES = 3
 
     # Create a mocked AnsariClaude instance with initial tools setup
@@ -0,0 +1,150 @@
+import sys
+import os
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+# Add the src directory to the path so we can import the modules
+src_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.insert(0, src_path)
+
+from ansari.agents.ansari_claude import AnsariClaude
+from ansari.util.response_cache import ResponseCache
+
+
+def _make_claude(make_claude, question):
+    """Create an agent asked `question`, whose mocked client answers every request with a short streamed reply."""
+    claude = make_claude([{"role": "user", "content": question}], message_logger=MagicMock())
+    claude.client.messages.create.side_effect = lambda **kwargs: iter(
+        [
+            SimpleNamespace(type="content_block_start", content_block=SimpleNamespace(type="text", text="")),
+            SimpleNamespace(type="content_block_delta", delta=SimpleNamespace(type="text_delta", text="Wa alaykum")),
+            SimpleNamespace(type="content_block_stop"),
+            SimpleNamespace(type="message_delta", delta=SimpleNamespace(stop_reason="end_turn")),
+            SimpleNamespace(type="message_stop"),
+        ]
+    )
+    return claude
+
+
+def test_make_key_depends_on_message_history():
+    history = [{"role": "user", "content": "Salam"}]
+    key = ResponseCache.make_key("model", "prompt", [], history)
+
+    assert key == ResponseCache.make_key("model", "prompt", [], [{"content": "Salam", "role": "user"}])
+    assert key != ResponseCache.make_key("model", "prompt", [], [{"role": "user", "content": "Salam alaykum"}])
+    assert key != ResponseCache.make_key("other-model", "prompt", [], history)
+
+
+def test_single_question_key_ignores_case_spacing_and_trailing_punctuation():
+    def key(question):
+        return ResponseCache.make_key("model", "prompt", [], [{"role": "user", "content": question}])
+
+    assert key("What is zakat?") == key("  what is   ZAKAT") == key("What is zakat ؟")
+    assert key("What is zakat?") != key("What is zakat al-fitr?")
+
+    # Longer conversations still need an exact match
+    follow_up = [{"role": "assistant", "content": "Zakat is..."}]
+    assert ResponseCache.make_key("model", "prompt", [], [{"role": "user", "content": "What is zakat?"}, *follow_up]) != (
+        ResponseCache.make_key("model", "prompt", [], [{"role": "user", "content": "what is zakat"}, *follow_up])
+    )
+
+
+def test_repeated_conversation_is_replayed_without_calling_claude(tmp_path, make_claude):
+    cache = ResponseCache(str(tmp_path), ttl=60)
+
+    with (
+        patch("ansari.agents.ansari_claude.get_response_cache", return_value=cache),
+        patch.object(AnsariClaude, "_get_system_prompt", return_value="System prompt"),
+    ):
+        first = _make_claude(make_claude, "Salam")
+        first_output = "".join(first.process_message_history())
+
+        second = _make_claude(make_claude, "Salam")
+        second_output = "".join(second.process_message_history())
+
+        other = _make_claude(make_claude, "What is zakat?")
+        "".join(other.process_message_history())
+
+    assert first.client.messages.create.call_count == 1
+    second.client.messages.create.assert_not_called()
+    other.client.messages.create.assert_called_once()
+
+    assert second_output == first_output == "Wa alaykum"
+    assert second.message_history == first.message_history
+    # The replayed assistant message is logged like a generated one
+    second.message_logger.log_many.assert_called_once()
+
+
+def _cited_reply(text, title):
+    """A streamed reply of `text` followed by a citation of the document titled `title`."""
+    citation = SimpleNamespace(cited_text="English: In the name of God", document_title=title)
+    return iter(
+        [
+            SimpleNamespace(type="content_block_start", content_block=SimpleNamespace(type="text", text="")),
+            SimpleNamespace(type="content_block_delta", delta=SimpleNamespace(type="text_delta", text=text)),
+            SimpleNamespace(type="content_block_delta", delta=SimpleNamespace(type="citations_delta", citation=citation)),
+            SimpleNamespace(type="content_block_stop"),
+            SimpleNamespace(type="message_delta", delta=SimpleNamespace(stop_reason="end_turn")),
+            SimpleNamespace(type="message_stop"),
+        ]
+    )
+
+
+def test_live_turn_after_a_replayed_one_numbers_citations_on(tmp_path, make_claude):
+    cache = ResponseCache(str(tmp_path), ttl=60)
+
+    with (
+        patch("ansari.agents.ansari_claude.get_response_cache", return_value=cache),
+        patch.object(AnsariClaude, "_get_system_prompt", return_value="System prompt"),
+    ):
+        first = _make_claude(make_claude, "Salam")
+        first.client.messages.create.side_effect = [_cited_reply("Bismillah", "Quran 1:1")]
+        list(first.process_message_history())
+
+        second = _make_claude(make_claude, "Salam")
+        second.client.messages.create.side_effect = [_cited_reply("Alhamdulillah", "Quran 1:2")]
+        with patch.object(second, "validate_message", wraps=second.validate_message) as mock_validate:
+            replayed = "".join(second.process_message_history())
+        second.message_history.append({"role": "user", "content": "And the next verse?"})
+        live = "".join(second.process_message_history())
+
+    assert replayed.startswith("Bismillah [1] ")
+    # The replayed answer was validated before it was cached, so it is logged as trusted
+    assert [call.args[0]["role"] for call in mock_validate.call_args_list] == ["user"]
+    second.client.messages.create.assert_called_once()
+    assert live.startswith("Alhamdulillah [2] ")
+    assert "[2] Quran 1:2:" in second.message_history[-1]["content"][0]["text"]
+
+
+def test_answers_from_a_routing_model_are_cached_separately(tmp_path, make_claude):
+    cache = ResponseCache(str(tmp_path), ttl=60)
+
+    with (
+        patch("ansari.agents.ansari_claude.get_response_cache", return_value=cache),
+        patch.object(AnsariClaude, "_get_system_prompt", return_value="System prompt"),
+    ):
+        list(_make_claude(make_claude, "Salam").process_message_history())
+
+        routed = _make_claude(make_claude, "Salam")
+        routed.settings.ANTHROPIC_ROUTING_MODEL = "claude-haiku-4-5"
+        list(routed.process_message_history())
+
+    routed.client.messages.create.assert_called_once()
+    assert routed.client.messages.create.call_args.kwargs["model"] == "claude-haiku-4-5"
+
+
+def test_failed_turn_is_not_cached(tmp_path, make_claude):
+    cache = ResponseCache(str(tmp_path), ttl=60)
+
+    with (
+        patch("ansari.agents.ansari_claude.get_response_cache", return_value=cache),
+        patch.object(AnsariClaude, "_get_system_prompt", return_value="System prompt"),
+    ):
+        failing = _make_claude(make_claude, "Salam")
+        failing.client.messages.create.side_effect = ValueError("broken request")
+        list(failing.process_message_history())
+
+        retry = _make_claude(make_claude, "Salam")
+        list(retry.process_message_history())
+
+    retry.client.messages.create.assert_called_once()